@@ -3,65 +3,83 @@
 import os
 import logging
 import argparse
-import json
 
 from jicbioimage.core.image import Image
-from jicbioimage.core.transform import transformation
 from jicbioimage.core.io import AutoName, AutoWrite
 from jicbioimage.segment import Region
 
-from utils import get_microscopy_collection
+import intermediates
+from utils import UnpackedIndex, PlaneCache
+from profiling import Profiling
 from parameters import Parameters
-from surface import surface_from_stack
 from segment import segment_cells
-from projection import (
-    project_wall,
-    project_marker,
-)
-from annotation import write_cell_views
+from pipeline import identity, leaf_surface_and_projections
+from annotation import leaf_views, padded_box, write_cell_views
+from celltable import CellTable
+from cellstore import CellStore, STORE_FNAME
+from writer import WriterPool
 
 __version__ = "0.5.0"
 
 AutoName.prefix_format = "{:03d}_"
 
 
-@transformation
-def identity(image):
-    """Return the image as is."""
-    return image
+def save_cells(cells, wall_projection, marker_projection, output_directory,
+               cell_store=False):
+    """Write annotated images and cell data of every cell.
 
-
-def save_cells(cells, wall_projection, marker_projection, output_directory):
+    The cell data are written to a json file per cell, or to a single
+    :class:`cellstore.CellStore` if ``cell_store`` is True.
+    """
     d = os.path.join(output_directory, "annotated-cells")
     if not os.path.isdir(d):
         os.mkdir(d)
-    for i in cells.identifiers:
-        region = cells.region_by_identifier(i)
-        celldata = dict(cell_id=i, centroid=list(region.centroid), area=region.area)
-        fpath_prefix = os.path.join(d, "cell-{:05d}".format(i))
-        write_cell_views(fpath_prefix, wall_projection, marker_projection, region, celldata)
-        with open(fpath_prefix + ".json", "w") as fh:
-            json.dump(celldata, fh)
+    table = CellTable.from_segmentation(cells)
+    views = leaf_views(wall_projection, marker_projection)
+    store = CellStore()
+    with WriterPool() as writer:
+        for i in cells.identifiers:
+            n = table.index(i)
+            box = padded_box(table.bounding_box(n), cells.shape)
+            offset = (box[0].start, box[1].start)
+            region = cells[box] == i
+            border = table.border_mask(n, box)
+            celldata = dict(cell_id=i,
+                            centroid=[float(c) for c in table.centroid[n]],
+                            area=int(table.area[n]))
+            fpath_prefix = os.path.join(d, "cell-{:05d}".format(i))
+            write_cell_views(fpath_prefix, views, region, border, offset,
+                             celldata, writer)
+            if cell_store:
+                store.append(celldata)
+            else:
+                writer.write_json(fpath_prefix + ".json", celldata)
+    if cell_store:
+        store.to_file(os.path.join(d, STORE_FNAME))
+
+
+def load_mask(fpath):
+    """Return mask region from mask file."""
+    mask_im = Image.from_file(fpath)
+    mask = Region.select_from_array(mask_im, 0)
+    identity(mask)
+    return mask
 
 
-def analyse_file(fpath, mask, output_directory, **kwargs):
+def analyse_file(fpath, mask, output_directory, cell_store=False, **kwargs):
     """Analyse a single file."""
     logging.info("Analysing file: {}".format(fpath))
 
-    microscopy_collection = get_microscopy_collection(fpath)
-
-    wall_stack = microscopy_collection.zstack(c=kwargs["wall_channel"])
-    wall_stack = identity(wall_stack)
-    surface = surface_from_stack(wall_stack, **kwargs)
-    wall_projection = project_wall(wall_stack, surface, **kwargs)
+    surface, wall_projection, marker_projection = \
+        leaf_surface_and_projections(fpath, **kwargs)
 
     cells = segment_cells(wall_projection, surface, mask, **kwargs)
 
-    marker_stack = microscopy_collection.zstack(c=kwargs["marker_channel"])
-    marker_stack = identity(marker_stack)
-    marker_projection = project_marker(marker_stack, surface, **kwargs)
+    save_cells(cells, wall_projection, marker_projection, output_directory,
+               cell_store)
 
-    save_cells(cells, wall_projection, marker_projection, output_directory)
+    # Wait for the intermediate images to be written.
+    intermediates.flush()
 
 
 def main():
@@ -73,6 +91,14 @@ def main():
     parser.add_argument("output_dir", help="Output directory")
     parser.add_argument("--debug", default=False, action="store_true",
                         help="Write out intermediate images")
+    parser.add_argument("--verify", default=False, action="store_true",
+                        help="Hash input image instead of trusting the index")
+    parser.add_argument("--plane-cache", default=False, action="store_true",
+                        help="Keep z-stacks as memory-mappable volumes")
+    parser.add_argument("--cell-store", default=False, action="store_true",
+                        help="Write cell data to one file, not one per cell")
+    parser.add_argument("--profile", default=False, action="store_true",
+                        help="Log time and memory use of every stage")
     args = parser.parse_args()
 
     # Check that the input file exists.
@@ -84,6 +110,18 @@ def main():
     # Read in the parameters.
     params = Parameters.from_file(args.parameters_file)
 
+    # Check that the input image has not changed since it was unpacked.
+    if args.verify:
+        UnpackedIndex.verify = True
+
+    # Write z-stacks that have not been read before as volumes.
+    if args.plane_cache:
+        PlaneCache.on = True
+
+    # Log the time and memory use of the transformations.
+    if args.profile:
+        Profiling.on = True
+
     # Create the output directory if it does not exist.
     if not os.path.isdir(args.output_dir):
         os.mkdir(args.output_dir)
@@ -92,6 +130,7 @@ def main():
     # Only write out intermediate images in debug mode.
     if not args.debug:
         AutoWrite.on = False
+    intermediates.configure(params)
 
     # Setup a logger for the script.
     log_fname = "audit.log"
@@ -107,10 +146,9 @@ def main():
     logging.info("Parameters: {}".format(params))
 
     # Run the analysis.
-    mask_im = Image.from_file(args.mask_file)
-    mask = Region.select_from_array(mask_im, 0)
-    identity(mask)
-    analyse_file(args.input_file, mask, args.output_dir, **params)
+    mask = load_mask(args.mask_file)
+    analyse_file(args.input_file, mask, args.output_dir,
+                 cell_store=args.cell_store, **params)
 
 if __name__ == "__main__":
     main()
@@ -10,16 +10,37 @@ import scipy.ndimage
 from jicbioimage.illustrate import AnnotatedImage
 
 
-def post_process_annotation(ann, dilated_region, celldata, rotation):
+#: Number of iterations used to dilate a cell to include its surroundings.
+DILATION = 20
+
+#: Padding around the cell bounding box that holds the dilated cell.
+CELL_BOX_PADDING = DILATION + 1
+
+
+def leaf_views(wall_projection, marker_projection):
+    """Return wall, marker and combined annotated images of the whole leaf."""
+    wall_ann = AnnotatedImage.from_grayscale(wall_projection, (1, 0, 0))
+    marker_ann = AnnotatedImage.from_grayscale(marker_projection, (0, 1, 0))
+    return wall_ann, marker_ann, wall_ann + marker_ann
+
+
+def padded_box(box, shape, padding=CELL_BOX_PADDING):
+    """Return bounding box slices padded and clipped to the image shape."""
+    return tuple([slice(max(s.start - padding, 0), min(s.stop + padding, dim))
+                  for s, dim in zip(box, shape)])
+
+
+def post_process_annotation(ann, dilated_region, celldata, rotation,
+                            offset=(0, 0)):
 
     # Crop box around region.
-    yis, xis = dilated_region.index_arrays
+    yis, xis = np.where(dilated_region)
     ymin, ymax = np.min(yis), np.max(yis)
     xmin, xmax = np.min(xis), np.max(xis)
     ann = ann[ymin:ymax,
               xmin:xmax]
-    celldata["dy_offset"] = ymin
-    celldata["dx_offset"] = xmin
+    celldata["dy_offset"] = ymin + offset[0]
+    celldata["dx_offset"] = xmin + offset[1]
 
     # Pad cropped box.
     ydim, xdim, zdim = ann.shape
@@ -43,17 +64,33 @@ def post_process_annotation(ann, dilated_region, celldata, rotation):
     return ann
 
 
-def write_cell_views(fpath_prefix, wall_projection, marker_projection, region, celldata):
-    wall_ann = AnnotatedImage.from_grayscale(wall_projection, (1, 0, 0))
-    marker_ann = AnnotatedImage.from_grayscale(marker_projection, (0, 1, 0))
-    ann = wall_ann + marker_ann
+def write_cell_views(fpath_prefix, views, region, border, offset, celldata,
+                     writer):
+    """Write wall, marker and combined images of a cell.
+
+    :param views: wall, marker and combined images of the whole leaf
+    :param region: boolean array of the cell in a box of the leaf, padded
+                   by :data:`CELL_BOX_PADDING` where possible
+    :param border: boolean array of the border of the cell in the same box
+    :param offset: (y, x) position of the box in the leaf
+    :param celldata: cell data dictionary with the centroid of the cell
+    :param writer: :class:`writer.WriterPool` used to write the images
+    """
+    ybox, xbox = region.shape
+    box = (slice(offset[0], offset[0] + ybox),
+           slice(offset[1], offset[1] + xbox))
+    wall_ann, marker_ann, ann = [v[box].copy() for v in views]
+
     color = (200, 200, 200)
-    ann.mask_region(region.border, color)
-    ann.draw_cross(region.centroid, color)
-    dilated_region = region.dilate(20)
-    wall_ann[np.logical_not(dilated_region)] = (0, 0, 0)
-    marker_ann[np.logical_not(dilated_region)] = (0, 0, 0)
-    ann[np.logical_not(dilated_region)] = (0, 0, 0)
+    ann.mask_region(border, color)
+    cy, cx = celldata["centroid"]
+    ann.draw_cross((cy - offset[0], cx - offset[1]), color)
+    dilated_region = scipy.ndimage.binary_dilation(region,
+                                                   iterations=DILATION)
+    outside = np.logical_not(dilated_region)
+    wall_ann[outside] = (0, 0, 0)
+    marker_ann[outside] = (0, 0, 0)
+    ann[outside] = (0, 0, 0)
 
 
 # If rotation is not 0, 90, 180, 270 the image becomes larger than then input
@@ -70,6 +107,6 @@ def write_cell_views(fpath_prefix, wall_projection, marker_projection, region, c
                                ("-combined", ann)]:
         fpath = fpath_prefix + suffix + ".png"
         annotation = post_process_annotation(annotation, dilated_region,
-                                             celldata, rotation)
+                                             celldata, rotation, offset)
 
-        scipy.misc.imsave(fpath, annotation)
+        writer.write_png(fpath, annotation)
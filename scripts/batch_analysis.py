@@ -0,0 +1,230 @@
+"""Run the cells-from-leaves analysis on many leaves in parallel.
+
+The manifest is a CSV file with one leaf per line::
+
+    data/leaf1.tif,data/leaf1-mask.tif,parameters/smallleaf1-params.yml
+
+Lines starting with ``#`` are ignored. Each leaf is written to a directory
+in the output directory named after its parameters file, e.g. ``smallleaf1``,
+with its own ``audit.log``. Leaves that share a parameters file are also
+named after their image, e.g. ``params-leaf1``.
+"""
+
+import os
+import csv
+import logging
+import argparse
+import resource
+import multiprocessing
+from collections import Counter
+from time import time
+
+from jicbioimage.core.io import AutoName, AutoWrite
+
+import analysis
+import intermediates
+from parameters import Parameters
+from profiling import Profiling
+from utils import run_in_processes, killed_status
+
+__version__ = "0.1.0"
+
+PARAMS_SUFFIX = "-params.yml"
+
+
+def leaf_name(parameters_file):
+    """Return leaf name derived from the parameters file name."""
+    fname = os.path.basename(parameters_file)
+    if fname.endswith(PARAMS_SUFFIX):
+        return fname[:-len(PARAMS_SUFFIX)]
+    return os.path.splitext(fname)[0]
+
+
+def leaf_names(jobs):
+    """Return list of the leaf names of (image, mask, parameters file) jobs.
+
+    Leaves are named after their parameters file, and also after their image
+    if several leaves share the parameters file. The names are unique, so
+    that no two leaves are written to the same directory.
+    """
+    names = [leaf_name(parameters_file) for _, _, parameters_file in jobs]
+    counts = Counter(names)
+    for i, (input_file, _, _) in enumerate(jobs):
+        if counts[names[i]] > 1:
+            image_name = os.path.splitext(os.path.basename(input_file))[0]
+            names[i] = "{}-{}".format(names[i], image_name)
+    duplicates = sorted([n for n, count in Counter(names).items()
+                         if count > 1])
+    if duplicates:
+        raise(RuntimeError("Leaves with the same name: {}".format(
+            ", ".join(duplicates))))
+    return names
+
+
+def read_manifest(fpath):
+    """Return list of (image, mask, parameters file) tuples.
+
+    Raises an error if two leaves would be written to the same directory.
+    """
+    jobs = []
+    with open(fpath) as fh:
+        for row in csv.reader(fh):
+            if len(row) == 0 or row[0].strip().startswith("#"):
+                continue
+            if len(row) != 3:
+                raise(RuntimeError(
+                    "Manifest lines need 3 columns: {}".format(row)))
+            jobs.append(tuple([item.strip() for item in row]))
+    leaf_names(jobs)
+    return jobs
+
+
+def _setup_leaf_logging(output_dir, debug):
+    """Direct the root logger of this process to the leaf's audit.log."""
+    logger = logging.getLogger()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    handler = logging.FileHandler(os.path.join(output_dir, "audit.log"))
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG if debug else logging.INFO)
+
+
+def analyse_leaf(job):
+    """Analyse one leaf; return a summary dictionary.
+
+    Runs in a worker process. Errors are logged to the leaf's audit.log and
+    reported in the summary rather than raised, so that one failing leaf
+    does not stop the others.
+    """
+    (input_file, mask_file, parameters_file, output_dir, debug, cell_store,
+     profile) = job
+    if not os.path.isdir(output_dir):
+        os.mkdir(output_dir)
+    AutoName.directory = output_dir
+    AutoWrite.on = debug
+    Profiling.on = profile
+    _setup_leaf_logging(output_dir, debug)
+
+    summary = dict(leaf=os.path.basename(output_dir), status="ok", error="")
+    start = time()
+    try:
+        params = Parameters.from_file(parameters_file)
+        logging.info("Script name: {}".format(analysis.__file__))
+        logging.info("Script version: {}".format(analysis.__version__))
+        logging.info("Batch script version: {}".format(__version__))
+        logging.info("Parameters: {}".format(params))
+        intermediates.configure(params)
+        mask = analysis.load_mask(mask_file)
+        analysis.analyse_file(input_file, mask, output_dir,
+                              cell_store=cell_store, **params)
+    except Exception as e:
+        logging.exception("Analysis failed")
+        summary["status"] = "failed"
+        summary["error"] = repr(e)
+    summary["seconds"] = round(time() - start, 1)
+
+    # Linux reports the peak resident set size in kilobytes.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    summary["peak_rss_mb"] = round(peak_rss / 1024., 1)
+    logging.info("Summary: {}".format(summary))
+    return summary
+
+
+def write_summary(summaries, fpath):
+    """Write per leaf summaries to a csv file."""
+    keys = ["leaf", "status", "seconds", "peak_rss_mb", "error"]
+    with open(fpath, "w") as fh:
+        writer = csv.DictWriter(fh, fieldnames=keys)
+        writer.writeheader()
+        for summary in sorted(summaries, key=lambda s: s["leaf"]):
+            writer.writerow(summary)
+
+
+def batch_analysis(jobs, output_dir, processes=None, debug=False,
+                   cell_store=False, profile=False):
+    """Analyse all leaves in a process pool; return list of summaries."""
+    leaf_jobs = []
+    for (input_file, mask_file, parameters_file), name in zip(jobs,
+                                                          leaf_names(jobs)):
+        leaf_dir = os.path.join(output_dir, name)
+        leaf_jobs.append((input_file, mask_file, parameters_file,
+                          leaf_dir, debug, cell_store, profile))
+
+    # A fresh process per leaf keeps the peak RSS reported for each leaf
+    # independent of the leaves analysed before it, and a leaf whose process
+    # is killed, e.g. by the out of memory killer, does not stop the others.
+    summaries = []
+    for job, summary, exitcode in run_in_processes(analyse_leaf, leaf_jobs,
+                                                   processes):
+        if summary is None:
+            summary = dict(leaf=os.path.basename(job[3]),
+                           status=killed_status(exitcode),
+                           error="",
+                           seconds="",
+                           peak_rss_mb="")
+        print("{leaf}: {status} in {seconds}s, "
+              "peak RSS {peak_rss_mb} MB".format(**summary))
+        summaries.append(summary)
+    write_summary(summaries, os.path.join(output_dir, "batch-summary.csv"))
+    return summaries
+
+
+def test_leaf_names():
+    jobs = [("data/leaf1.tif", "data/leaf1-mask.tif", "p/leaf1-params.yml"),
+            ("data/leaf2.tif", "data/leaf2-mask.tif", "p/params.yml"),
+            ("data/leaf3.lif", "data/leaf3-mask.tif", "p/params.yml")]
+    assert leaf_names(jobs) == ["leaf1", "params-leaf2", "params-leaf3"]
+    try:
+        leaf_names(jobs + [("other/leaf3.tif", "m.tif", "p/params.yml")])
+    except RuntimeError as e:
+        assert "params-leaf3" in str(e)
+    else:
+        assert False, "Duplicate leaf names not rejected"
+
+
+def main():
+    # Parse the command line arguments.
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("manifest_file", help="Manifest file")
+    parser.add_argument("output_dir", help="Output directory")
+    parser.add_argument("-p", "--processes", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Number of worker processes")
+    parser.add_argument("--debug", default=False, action="store_true",
+                        help="Write out intermediate images")
+    parser.add_argument("--cell-store", default=False, action="store_true",
+                        help="Write cell data to one file per leaf")
+    parser.add_argument("--profile", default=False, action="store_true",
+                        help="Log time and memory use of every stage")
+    args = parser.parse_args()
+
+    # Check that the manifest file and the files it lists exist.
+    if not os.path.isfile(args.manifest_file):
+        parser.error("{} not a file".format(args.manifest_file))
+    try:
+        jobs = read_manifest(args.manifest_file)
+    except RuntimeError as e:
+        parser.error(str(e))
+    for job in jobs:
+        for fpath in job:
+            if not os.path.isfile(fpath):
+                parser.error("{} not a file".format(fpath))
+
+    # Create the output directory if it does not exist.
+    if not os.path.isdir(args.output_dir):
+        os.mkdir(args.output_dir)
+
+    # Run the analyses.
+    summaries = batch_analysis(jobs, args.output_dir,
+                               processes=args.processes, debug=args.debug,
+                               cell_store=args.cell_store,
+                               profile=args.profile)
+    failed = [s["leaf"] for s in summaries if s["status"] != "ok"]
+    if failed:
+        parser.exit(1, "Failed leaves: {}\n".format(", ".join(failed)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,131 @@
-"""Script to unpack all images; to make the analysis scripts run faster."""
+"""Script to unpack all images; to make the analysis scripts run faster.
+
+Files are unpacked in parallel. Files that are already unpacked are
+skipped, using the index in the backend directory to avoid hashing them
+again. Each file is unpacked into a staging directory inside the backend
+and moved into place once complete, so an interrupted run can simply be
+restarted.
+
+With ``--plane-cache`` every z-stack is also written as one ``.npy`` volume
+next to its planes, so that the analysis scripts can memory-map it rather
+than decode the planes; see :class:`utils.MappedMicroscopyCollection`.
+"""
 
 import os
 import argparse
+import shutil
+import tempfile
+import multiprocessing
 from time import time
 
-from utils import get_microscopy_collection
+from utils import (
+    get_data_manager,
+    clean_backend,
+    read_index,
+    write_index,
+    index_entry,
+    lookup_index,
+    is_unpacked,
+    unpack,
+    MappedMicroscopyCollection,
+    PlaneCache,
+    STAGING_DNAME,
+)
+
+
+def _init_worker(staging_dir, plane_cache):
+    # The jicbioimage converter unpacks into a temporary directory and then
+    # moves it into the backend. Keeping the temporary directory on the same
+    # file system as the backend makes that move an atomic rename.
+    tempfile.tempdir = staging_dir
+    PlaneCache.on = plane_cache
+
+
+def write_volumes(md5_hex):
+    """Write the volumes of all z-stacks of an unpacked file."""
+    _, backend_dir = get_data_manager()
+    directory = os.path.join(backend_dir, md5_hex)
+    collection = MappedMicroscopyCollection(directory)
+    collection.parse_manifest(os.path.join(directory, "manifest.json"))
+    for s in collection.series:
+        for c in collection.channels(s):
+            for t in collection.timepoints(s):
+                if collection.mapped_zstack_array(s=s, c=c, t=t) is None:
+                    collection.write_volume(s=s, c=c, t=t)
 
-def unpack_all(input_dir):
-    for fname in os.listdir(input_dir):
+
+def unpack_file(job):
+    """Unpack a file; return (fpath, md5 hex digest, seconds, error).
+
+    The job is the file path and its md5 hex digest if it is already
+    unpacked, otherwise None.
+    """
+    fpath, md5_hex = job
+    start = time()
+    try:
+        if md5_hex is None:
+            md5_hex = unpack(fpath)
+        if PlaneCache.on:
+            write_volumes(md5_hex)
+    except Exception as e:
+        return fpath, None, time() - start, repr(e)
+    return fpath, md5_hex, time() - start, None
+
+
+def unpack_all(input_dir, processes=None, plane_cache=False):
+    _, backend_dir = get_data_manager()
+    clean_backend(backend_dir)
+    staging_dir = os.path.join(backend_dir, STAGING_DNAME)
+    os.mkdir(staging_dir)
+
+    index = read_index(backend_dir)
+    jobs = []
+    for fname in sorted(os.listdir(input_dir)):
         fpath = os.path.join(input_dir, fname)
-        print("Processing {}...".format(fpath))
-        start = time()
-        mc = get_microscopy_collection(fpath)
-        end = time()
-        print("time elapsed {} seconds.".format(end-start))
+        if not os.path.isfile(fpath):
+            continue
+        md5_hex = lookup_index(index, fpath)
+        if md5_hex is None or not is_unpacked(backend_dir, md5_hex):
+            md5_hex = None
+        elif not plane_cache:
+            print("Skipping {}, already unpacked.".format(fpath))
+            continue
+        jobs.append((fpath, md5_hex))
+
+    failed = []
+    pool = multiprocessing.Pool(processes=processes,
+                                initializer=_init_worker,
+                                initargs=(staging_dir, plane_cache))
+    try:
+        for fpath, md5_hex, elapsed, error in pool.imap_unordered(unpack_file,
+                                                                  jobs):
+            if error is not None:
+                print("Failed {}: {}".format(fpath, error))
+                failed.append(fpath)
+                continue
+            print("Processed {}, time elapsed {} seconds.".format(fpath,
+                                                                  elapsed))
+            key, entry = index_entry(fpath, md5_hex)
+            index[key] = entry
+            write_index(backend_dir, index)
+    finally:
+        pool.close()
+        pool.join()
+    shutil.rmtree(staging_dir)
+    return failed
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("input_dir", help="Input directory")
+    parser.add_argument("-p", "--processes", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Number of worker processes")
+    parser.add_argument("--plane-cache", default=False, action="store_true",
+                        help="Also write z-stacks as memory-mappable volumes")
     args = parser.parse_args()
     if not os.path.isdir(args.input_dir):
         parser.error("{} not a directory".format(args.input_dir))
-    unpack_all(args.input_dir)
+    failed = unpack_all(args.input_dir, args.processes, args.plane_cache)
+    if failed:
+        parser.exit(1, "Failed to unpack: {}\n".format(", ".join(failed)))
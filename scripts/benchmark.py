@@ -0,0 +1,318 @@
+"""Benchmark the pipeline stages on synthetic leaf stacks.
+
+A synthetic leaf is a pair of wall and marker z-stacks of a sheet of
+polygonal cells lying on a curved surface, and a mask of the leaf. The
+stacks are generated from a seed, so the same preset gives the same leaf
+on every run; no input files are needed.
+
+Each stage is run in a fresh child process so that its peak memory can be
+measured independently of the other stages. The wall time, CPU time, peak
+resident set size and increase of the resident set size of every stage are
+written to a json file, which can be compared with that of another commit::
+
+    python scripts/benchmark.py small bench-small.json
+    python scripts/benchmark.py small bench-new.json --compare bench-small.json
+"""
+
+import os
+import json
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from time import time
+
+import numpy as np
+import scipy.ndimage as nd
+
+from jicbioimage.core.io import AutoWrite
+from jicbioimage.segment import SegmentedImage
+
+from parameters import Parameters
+from surface import surface_from_stack
+from projection import project_wall, project_marker
+from segment import segment_cells, remove_cells_not_in_mask
+from cellstore import TAG_KEYS, json_fpaths
+from analysis import save_cells
+from tensor_csv import write_csv
+
+__version__ = "0.1.0"
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+PARAMETERS_DIR = os.path.abspath(os.path.join(HERE, "..", "parameters"))
+
+#: Stack shape, typical cell diameter in pixels and parameters file.
+PRESETS = dict(
+    small=dict(shape=(512, 512, 30), cell_size=30,
+               parameters_file="smallleaf1-params.yml"),
+    large=dict(shape=(2048, 2048, 40), cell_size=40,
+               parameters_file="largeleaf0-params.yml"),
+)
+
+STAGES = ["surface_from_stack", "project_wall", "project_marker",
+          "segment_cells", "remove_cells_not_in_mask", "save_cells",
+          "write_csv"]
+
+
+def synthetic_leaf(shape, cell_size, seed=0):
+    """Return wall stack, marker stack and mask of a synthetic leaf.
+
+    The walls and markers are bright in a band of z-slices below a smoothly
+    curved surface. The mask is an ellipse covering most of the frame.
+    """
+    random = np.random.RandomState(seed)
+    ydim, xdim, zdim = shape
+
+    # Polygonal cells around random centres; walls where the cells meet.
+    num_cells = max(1, (ydim * xdim) // (cell_size * cell_size))
+    centres = np.zeros((ydim, xdim), dtype=np.int32)
+    centres[random.randint(0, ydim, num_cells),
+            random.randint(0, xdim, num_cells)] = np.arange(1, num_cells + 1)
+    indices = nd.distance_transform_edt(centres == 0, return_distances=False,
+                                        return_indices=True)
+    cells = centres[indices[0], indices[1]]
+    walls = np.zeros((ydim, xdim), dtype=bool)
+    walls[1:] |= cells[1:] != cells[:-1]
+    walls[:, 1:] |= cells[:, 1:] != cells[:, :-1]
+    walls = nd.binary_dilation(walls)
+
+    # Markers are spots on the walls, roughly one per cell.
+    wall_ys, wall_xs = np.nonzero(walls)
+    spots = random.randint(0, len(wall_ys), num_cells)
+    markers = np.zeros((ydim, xdim), dtype=bool)
+    markers[wall_ys[spots], wall_xs[spots]] = True
+    markers = nd.binary_dilation(markers, iterations=2)
+
+    ys, xs = np.mgrid[0:ydim, 0:xdim]
+    depth = (zdim / 3. + zdim / 8. * np.sin(2 * np.pi * ys / ydim)
+             * np.cos(2 * np.pi * xs / xdim)).astype(np.int64)
+    zs = np.arange(zdim)
+    band = (zs >= depth[:, :, np.newaxis]) & (zs < depth[:, :, np.newaxis] + 3)
+
+    wall_stack = random.randint(0, 30, shape).astype(np.uint8)
+    wall_stack[band] += 60
+    wall_stack[band & walls[:, :, np.newaxis]] += 150
+    marker_stack = random.randint(0, 20, shape).astype(np.uint8)
+    marker_stack[band & markers[:, :, np.newaxis]] += 200
+
+    mask = (((ys - ydim / 2.) / (0.45 * ydim)) ** 2
+            + ((xs - xdim / 2.) / (0.45 * xdim)) ** 2) <= 1
+    return wall_stack, marker_stack, mask
+
+
+def tag_cells(directory, seed=0):
+    """Add random marker coordinates to the cell json files of a leaf."""
+    random = np.random.RandomState(seed)
+    for fpath in json_fpaths(directory):
+        with open(fpath) as fh:
+            celldata = json.load(fh)
+        for key in TAG_KEYS:
+            celldata[key] = random.uniform(0.3, 0.7)
+        with open(fpath, "w") as fh:
+            json.dump(celldata, fh)
+
+
+def run_stage(name, state, params):
+    """Run a stage; return dictionary of arrays to add to the state."""
+    if name == "surface_from_stack":
+        surface = surface_from_stack(state["wall_stack"], **params)
+        return dict(surface=surface)
+    if name == "project_wall":
+        wall_projection = project_wall(state["wall_stack"], state["surface"],
+                                       **params)
+        return dict(wall_projection=wall_projection)
+    if name == "project_marker":
+        marker_projection = project_marker(state["marker_stack"],
+                                           state["surface"], **params)
+        return dict(marker_projection=marker_projection)
+    if name == "segment_cells":
+        cells = segment_cells(state["wall_projection"], state["surface"],
+                              state["mask"], **params)
+        return dict(cells=cells)
+    if name == "remove_cells_not_in_mask":
+        remove_cells_not_in_mask(state["cells"].copy(), state["mask"])
+        return {}
+    if name == "save_cells":
+        cells = SegmentedImage.from_array(state["cells"])
+        save_cells(cells, state["wall_projection"],
+                   state["marker_projection"], state["output_dir"])
+        return {}
+    if name == "write_csv":
+        write_csv(os.path.join(state["output_dir"], "annotated-cells"),
+                  os.path.join(state["output_dir"], "tensors.csv"), False)
+        return {}
+    raise(ValueError("Unknown stage: {}".format(name)))
+
+
+def _rss_mb():
+    """Return current resident set size in MB, or None if not known."""
+    try:
+        with open("/proc/self/statm") as fh:
+            pages = int(fh.read().split()[1])
+    except (IOError, OSError):
+        return None
+    return pages * resource.getpagesize() / (1024. * 1024.)
+
+
+def _measure_stage(conn, name, state, params):
+    """Run a stage in a child process and send its measurements."""
+    try:
+        start_rss = _rss_mb()
+        start_usage = resource.getrusage(resource.RUSAGE_SELF)
+        start = time()
+        results = run_stage(name, state, params)
+        wall_seconds = time() - start
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu_seconds = (usage.ru_utime + usage.ru_stime
+                       - start_usage.ru_utime - start_usage.ru_stime)
+
+        # Linux reports the peak resident set size in kilobytes.
+        peak_rss = usage.ru_maxrss / 1024.
+        measurement = dict(stage=name,
+                           wall_seconds=round(wall_seconds, 3),
+                           cpu_seconds=round(cpu_seconds, 3),
+                           peak_rss_mb=round(peak_rss, 1),
+                           rss_increase_mb=None)
+        if start_rss is not None:
+            measurement["rss_increase_mb"] = round(peak_rss - start_rss, 1)
+        results = dict((k, np.asarray(v)) for k, v in results.items())
+        conn.send((measurement, results, None))
+    except Exception as e:
+        conn.send((None, None, repr(e)))
+    conn.close()
+
+
+def measure_stage(name, state, params):
+    """Return measurement of a stage and the arrays it adds to the state."""
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_measure_stage,
+                                      args=(child_conn, name, state, params))
+    process.start()
+    child_conn.close()
+    measurement, results, error = parent_conn.recv()
+    process.join()
+    if error is not None:
+        raise(RuntimeError("Stage {} failed: {}".format(name, error)))
+    return measurement, results
+
+
+def git_commit():
+    """Return the commit of the working tree, or None if not known."""
+    try:
+        output = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                         cwd=HERE,
+                                         stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode("utf-8").strip()
+
+
+def benchmark(shape, cell_size, params, stages=STAGES, seed=0):
+    """Return list of stage measurements on a synthetic leaf."""
+    AutoWrite.on = False
+    wall_stack, marker_stack, mask = synthetic_leaf(shape, cell_size, seed)
+    output_dir = tempfile.mkdtemp()
+    state = dict(wall_stack=wall_stack,
+                 marker_stack=marker_stack,
+                 mask=mask,
+                 output_dir=output_dir)
+    measurements = []
+    try:
+        for name in STAGES:
+            if name == "write_csv":
+                tag_cells(os.path.join(output_dir, "annotated-cells"), seed)
+            measurement, results = measure_stage(name, state, params)
+            state.update(results)
+            if name not in stages:
+                continue
+            if "cells" in results:
+                measurement["num_cells"] = len(np.unique(results["cells"])) - 1
+            measurements.append(measurement)
+            print("{stage}: {wall_seconds}s wall, {cpu_seconds}s cpu, "
+                  "peak RSS {peak_rss_mb} MB".format(**measurement))
+    finally:
+        shutil.rmtree(output_dir)
+    return measurements
+
+
+def compare(measurements, previous):
+    """Print the ratios of the wall times to those of a previous run."""
+    previous = dict((m["stage"], m) for m in previous)
+    for m in measurements:
+        p = previous.get(m["stage"])
+        if p is None or not p["wall_seconds"]:
+            continue
+        print("{}: {:.2f}x previous wall time, {:+.1f} MB peak RSS".format(
+            m["stage"],
+            m["wall_seconds"] / p["wall_seconds"],
+            m["peak_rss_mb"] - p["peak_rss_mb"]))
+
+
+def test_synthetic_leaf():
+    wall_stack, marker_stack, mask = synthetic_leaf((60, 50, 10), 10)
+    assert wall_stack.shape == (60, 50, 10)
+    assert marker_stack.shape == (60, 50, 10)
+    assert wall_stack.dtype == np.uint8
+    assert mask.shape == (60, 50)
+    assert mask[30, 25] and not mask[0, 0]
+    assert wall_stack.max() > 200
+    again = synthetic_leaf((60, 50, 10), 10)
+    assert np.array_equal(wall_stack, again[0])
+
+
+def main():
+    # Parse the command line arguments.
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("preset", choices=sorted(PRESETS.keys()),
+                        help="Size of the synthetic leaf")
+    parser.add_argument("output_file", help="Output json file")
+    parser.add_argument("--shape", type=int, nargs=3,
+                        metavar=("YDIM", "XDIM", "ZDIM"),
+                        help="Override the stack shape of the preset")
+    parser.add_argument("--parameters-file",
+                        help="Override the parameters file of the preset")
+    parser.add_argument("--stage", action="append", choices=STAGES,
+                        help="Only report this stage; may be repeated")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the synthetic leaf")
+    parser.add_argument("--compare", help="Json file of a previous run")
+    args = parser.parse_args()
+
+    preset = PRESETS[args.preset]
+    shape = tuple(args.shape or preset["shape"])
+    parameters_file = args.parameters_file
+    if parameters_file is None:
+        parameters_file = os.path.join(PARAMETERS_DIR,
+                                       preset["parameters_file"])
+    if not os.path.isfile(parameters_file):
+        parser.error("{} not a file".format(parameters_file))
+    if args.compare and not os.path.isfile(args.compare):
+        parser.error("{} not a file".format(args.compare))
+    params = Parameters.from_file(parameters_file)
+
+    # Run the benchmark.
+    measurements = benchmark(shape, preset["cell_size"], params,
+                             stages=args.stage or STAGES, seed=args.seed)
+    result = dict(version=__version__,
+                  commit=git_commit(),
+                  platform=platform.platform(),
+                  preset=args.preset,
+                  shape=list(shape),
+                  parameters_file=os.path.basename(parameters_file),
+                  seed=args.seed,
+                  stages=measurements)
+    with open(args.output_file, "w") as fh:
+        json.dump(result, fh, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fh:
+            compare(measurements, json.load(fh)["stages"])
+
+
+if __name__ == "__main__":
+    main()
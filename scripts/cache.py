@@ -0,0 +1,111 @@
+"""Module for caching intermediate arrays on disk.
+
+Arrays are stored as compressed ``.npz`` files named after a key. The least
+recently used files are evicted when the cache grows beyond its size limit.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+
+import numpy as np
+
+from jicbioimage.core.image import Image
+
+from utils import get_data_dir
+
+
+class ArtifactCache(object):
+    """Settings for the artifact cache."""
+
+    #: Whether or not the artifact cache is used.
+    on = True
+
+    #: Cache directory; defaults to the cache directory in the output dir.
+    directory = None
+
+    #: Size limit of the cache directory.
+    max_size_mb = 10 * 1024
+
+
+def cache_directory():
+    """Return the cache directory, creating it if it does not exist."""
+    directory = ArtifactCache.directory
+    if directory is None:
+        directory = os.path.join(get_data_dir(), "cache")
+    if not os.path.isdir(directory):
+        os.mkdir(directory)
+    return directory
+
+
+def artifact_key(md5_hex, params, keys, version):
+    """Return cache key for an input file hash and a subset of parameters.
+
+    :param version: version of the code computing the artifacts; bump it
+                    when their results change so that old files are not used
+    """
+    subset = dict((k, params.get(k)) for k in keys)
+    description = json.dumps([md5_hex, subset, version], sort_keys=True)
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+
+def _fpath(key):
+    return os.path.join(cache_directory(), key + ".npz")
+
+
+def load(key, names):
+    """Return tuple of cached images, or None if not cached."""
+    fpath = _fpath(key)
+    if not os.path.isfile(fpath):
+        return None
+    try:
+        with np.load(fpath) as npz:
+            arrays = tuple([npz[name].view(Image) for name in names])
+    except (IOError, KeyError, ValueError):
+        logging.warning("Ignoring unreadable cache file: {}".format(fpath))
+        return None
+
+    # Mark the file as recently used.
+    os.utime(fpath, None)
+    return arrays
+
+
+def save(key, max_size_mb=None, **arrays):
+    """Save arrays to the cache and evict old files if it is too large."""
+    directory = cache_directory()
+    fd, tmp_fpath = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "wb") as fh:
+        np.savez_compressed(fh, **arrays)
+    os.rename(tmp_fpath, _fpath(key))
+    if max_size_mb is None:
+        max_size_mb = ArtifactCache.max_size_mb
+    evict(max_size_mb)
+
+
+def evict(max_size_mb):
+    """Remove least recently used files until the cache fits the limit."""
+    directory = cache_directory()
+    entries = []
+    for fname in os.listdir(directory):
+        if not fname.endswith(".npz"):
+            continue
+        fpath = os.path.join(directory, fname)
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            continue  # Evicted by another process.
+        entries.append((st.st_mtime, st.st_size, fpath))
+
+    total = sum([size for _, size, _ in entries])
+    limit = max_size_mb * 1024 * 1024
+    for _, size, fpath in sorted(entries):
+        if total <= limit:
+            break
+        logging.info("Evicting cache file: {}".format(fpath))
+        try:
+            os.remove(fpath)
+        except OSError:
+            pass
+        total -= size
@@ -0,0 +1,282 @@
+"""Columnar store of the cell data of a leaf.
+
+The cell data of all the cells of a leaf are stored as one structured numpy
+array in the ``annotated-cells`` directory, instead of one json file per
+cell. The store can be exported to, and the tagged marker coordinates
+imported back from, the json files used by the cells-from-leaves-tagger::
+
+    python scripts/cellstore.py export output/annotated-cells
+    python scripts/cellstore.py import output/annotated-cells
+
+Json files modified after the store are imported when the cell data is read,
+so that tags are not lost if the import is forgotten.
+"""
+
+import os
+import json
+import argparse
+import tempfile
+
+import numpy as np
+
+STORE_FNAME = "cell-store.npy"
+
+TAG_KEYS = ["normalised_marker_y_coord", "normalised_marker_x_coord"]
+
+DTYPE = np.dtype([
+    ("cell_id", np.int64),
+    ("centroid", np.float64, (2,)),
+    ("area", np.int64),
+    ("dy_offset", np.int64),
+    ("dx_offset", np.int64),
+    ("ydim", np.int64),
+    ("xdim", np.int64),
+    ("rotation", np.int64),
+    ("normalised_marker_y_coord", np.float64),
+    ("normalised_marker_x_coord", np.float64),
+])
+
+INT_KEYS = ["cell_id", "area", "dy_offset", "dx_offset", "ydim", "xdim",
+            "rotation"]
+
+
+def json_fpaths(directory):
+    """Return sorted list of json files in a directory."""
+    return [os.path.join(directory, f)
+            for f in sorted(os.listdir(directory))
+            if f.endswith(".json")]
+
+
+def json_fpath(directory, cell_id):
+    """Return path to the json file of a cell."""
+    return os.path.join(directory, "cell-{:05d}.json".format(cell_id))
+
+
+class CellStore(object):
+    """Cell data of a leaf stored in a structured array."""
+
+    def __init__(self, records=None):
+        if records is None:
+            records = np.zeros(0, dtype=DTYPE)
+        self._records = records
+        self._pending = []
+        self._rows = None
+
+    @classmethod
+    def from_file(cls, fpath, mmap_mode=None):
+        """Read cell store from file.
+
+        Use ``mmap_mode="r+"`` to update the tags of a large store in place.
+        """
+        return cls(np.load(fpath, mmap_mode=mmap_mode))
+
+    @classmethod
+    def from_json_dir(cls, directory):
+        """Return cell store built from the json files in a directory."""
+        store = cls()
+        for fpath in json_fpaths(directory):
+            with open(fpath) as fh:
+                store.append(json.load(fh))
+        return store
+
+    @property
+    def records(self):
+        """Structured array with one record per cell."""
+        if self._pending:
+            pending = np.array(self._pending, dtype=DTYPE)
+            self._records = np.concatenate([self._records, pending])
+            self._pending = []
+        return self._records
+
+    def __len__(self):
+        return len(self._records) + len(self._pending)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.celldata(i)
+
+    def _row(self, cell_id):
+        if self._rows is None or len(self._rows) != len(self):
+            self._rows = dict((int(c), i)
+                              for i, c in enumerate(self.records["cell_id"]))
+        return self._rows[cell_id]
+
+    def append(self, celldata):
+        """Append the cell data dictionary of a cell."""
+        row = [celldata[name] for name in DTYPE.names if name not in TAG_KEYS]
+        row.extend([celldata.get(key, np.nan) for key in TAG_KEYS])
+        self._pending.append(tuple(row))
+
+    def update(self, cell_id, **fields):
+        """Update fields of a cell, e.g. the tagged marker coordinates."""
+        row = self._row(cell_id)
+        for name, value in fields.items():
+            self.records[name][row] = value
+
+    def celldata(self, row):
+        """Return the cell data dictionary of the cell in a row."""
+        record = self.records[row]
+        celldata = dict((name, int(record[name])) for name in INT_KEYS)
+        celldata["centroid"] = [float(c) for c in record["centroid"]]
+        for key in TAG_KEYS:
+            if not np.isnan(record[key]):
+                celldata[key] = float(record[key])
+        return celldata
+
+    def to_file(self, fpath):
+        """Write cell store to file, replacing any existing file."""
+        fd, tmp_fpath = tempfile.mkstemp(dir=os.path.dirname(fpath) or ".",
+                                         suffix=".tmp")
+        with os.fdopen(fd, "wb") as fh:
+            np.save(fh, self.records)
+        os.rename(tmp_fpath, fpath)
+
+    def export_json(self, directory):
+        """Write the json file of every cell to a directory."""
+        for celldata in self:
+            with open(json_fpath(directory, celldata["cell_id"]), "w") as fh:
+                json.dump(celldata, fh)
+
+    def import_tags(self, directory, fpaths=None):
+        """Update the tagged marker coordinates from the json files.
+
+        :param fpaths: json files to import; all those in the directory
+                       by default
+        :returns: number of tagged cells
+        """
+        if fpaths is None:
+            fpaths = json_fpaths(directory)
+        num_tagged = 0
+        for fpath in fpaths:
+            with open(fpath) as fh:
+                celldata = json.load(fh)
+            tags = dict((key, celldata.get(key, np.nan)) for key in TAG_KEYS)
+            self.update(celldata["cell_id"], **tags)
+            if all([key in celldata for key in TAG_KEYS]):
+                num_tagged += 1
+        return num_tagged
+
+
+def stale_json_fpaths(directory):
+    """Return json files modified after the cell store in a directory."""
+    store_mtime = os.stat(os.path.join(directory, STORE_FNAME)).st_mtime
+    return [fpath for fpath in json_fpaths(directory)
+            if os.stat(fpath).st_mtime > store_mtime]
+
+
+def read_store(directory):
+    """Return the cell store in a directory, with up to date tags.
+
+    Json files modified after the store, e.g. tagged after an export without
+    an import, have their tags imported and the store is written again.
+    """
+    store_fpath = os.path.join(directory, STORE_FNAME)
+    store = CellStore.from_file(store_fpath)
+    fpaths = stale_json_fpaths(directory)
+    if fpaths:
+        store.import_tags(directory, fpaths)
+        store.to_file(store_fpath)
+    return store
+
+
+def read_celldata(directory):
+    """Return list of the cell data dictionaries in a directory.
+
+    Uses the cell store if there is one and the json files otherwise.
+    """
+    store_fpath = os.path.join(directory, STORE_FNAME)
+    if os.path.isfile(store_fpath):
+        return list(read_store(directory))
+    celldata_list = []
+    for fpath in json_fpaths(directory):
+        with open(fpath) as fh:
+            celldata_list.append(json.load(fh))
+    return celldata_list
+
+
+def tagged_celldata(directory):
+    """Return list of the cell data of the tagged cells, by cell id."""
+    tagged = [celldata for celldata in read_celldata(directory)
+              if all([key in celldata for key in TAG_KEYS])]
+    return sorted(tagged, key=lambda celldata: celldata["cell_id"])
+
+
+def test_cell_store():
+    import shutil
+    celldata = dict(cell_id=3, centroid=[1.5, 2.0], area=4, dy_offset=-20,
+                    dx_offset=-19, ydim=60, xdim=61, rotation=90)
+    store = CellStore()
+    store.append(celldata)
+    store.append(dict(celldata, cell_id=7, normalised_marker_y_coord=0.25,
+                      normalised_marker_x_coord=0.5))
+    assert len(store) == 2
+    assert store.celldata(0) == celldata
+    assert store.celldata(1)["normalised_marker_x_coord"] == 0.5
+
+    directory = tempfile.mkdtemp()
+    try:
+        store.export_json(directory)
+        with open(json_fpath(directory, 3)) as fh:
+            tagged = json.load(fh)
+        tagged["normalised_marker_y_coord"] = 0.75
+        tagged["normalised_marker_x_coord"] = 0.125
+        with open(json_fpath(directory, 3), "w") as fh:
+            json.dump(tagged, fh)
+
+        store_fpath = os.path.join(directory, STORE_FNAME)
+        store.to_file(store_fpath)
+        store = CellStore.from_file(store_fpath, mmap_mode="r+")
+        assert store.import_tags(directory) == 2
+        store.records.flush()
+        assert read_celldata(directory)[0] == tagged
+
+        # Tags in json files modified after the store are imported.
+        for fpath in json_fpaths(directory):
+            os.utime(fpath, (0, 0))
+        os.utime(store_fpath, (1, 1))
+        tagged["normalised_marker_x_coord"] = 0.375
+        with open(json_fpath(directory, 3), "w") as fh:
+            json.dump(tagged, fh)
+        assert stale_json_fpaths(directory) == [json_fpath(directory, 3)]
+        assert read_celldata(directory)[0] == tagged
+        assert stale_json_fpaths(directory) == []
+        assert CellStore.from_file(store_fpath).celldata(0) == tagged
+
+        os.remove(store_fpath)
+        assert read_celldata(directory)[0] == tagged
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("command", choices=["export", "import", "create"],
+                        help="Export json files, import tags from them, "
+                             "or create the store from them")
+    parser.add_argument("input_dir", help="Annotated cells directory")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.input_dir):
+        parser.error("{} not a directory".format(args.input_dir))
+    store_fpath = os.path.join(args.input_dir, STORE_FNAME)
+    if args.command == "create":
+        store = CellStore.from_json_dir(args.input_dir)
+        store.to_file(store_fpath)
+        print("Stored {} cells".format(len(store)))
+        return
+    if not os.path.isfile(store_fpath):
+        parser.error("{} not a file".format(store_fpath))
+
+    if args.command == "export":
+        store = CellStore.from_file(store_fpath)
+        store.export_json(args.input_dir)
+        print("Exported {} cells".format(len(store)))
+    else:
+        store = CellStore.from_file(store_fpath, mmap_mode="r+")
+        num_tagged = store.import_tags(args.input_dir)
+        store.records.flush()
+        print("Imported tags of {} cells".format(num_tagged))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""Module for storing per-cell properties of a segmentation.
+
+The :class:`CellTable` is computed in one pass over a segmented image and
+stores one row per cell in numpy arrays, in ascending cell id order. The
+border pixels of the cells are stored as runs of pixels along the rows,
+grouped by cell in the same way as a sparse matrix.
+"""
+
+import numpy as np
+import scipy.ndimage
+
+COLUMNS = [
+    "cell_id",
+    "area",
+    "centroid",
+    "bbox",
+    "eccentricity",
+    "orientation",
+    "major_axis_length",
+    "minor_axis_length",
+    "border_run_offsets",
+    "border_run_rows",
+    "border_run_starts",
+    "border_run_stops",
+]
+
+
+def _border(cells):
+    """Return boolean image of cell pixels on the border of their cell.
+
+    These are the pixels removed by a binary erosion of each cell with a
+    cross shaped structuring element, treating pixels outside the image as
+    background.
+    """
+    padded = np.pad(cells, 1, mode="constant")
+    center = padded[1:-1, 1:-1]
+    differs = padded[:-2, 1:-1] != center
+    differs |= padded[2:, 1:-1] != center
+    differs |= padded[1:-1, :-2] != center
+    differs |= padded[1:-1, 2:] != center
+    return np.logical_and(center != 0, differs)
+
+
+def _border_runs(cells, index_of_label, num_cells):
+    """Return border run offsets, rows, starts and stops."""
+    rows, cols = np.nonzero(_border(cells))
+    indices = index_of_label[cells[rows, cols]]
+
+    # Sort by cell; the stable sort keeps the pixels of a cell in row order.
+    order = np.argsort(indices, kind="mergesort")
+    rows, cols, indices = rows[order], cols[order], indices[order]
+
+    new_run = np.ones(len(rows), dtype=bool)
+    new_run[1:] = ((indices[1:] != indices[:-1])
+                   | (rows[1:] != rows[:-1])
+                   | (cols[1:] != cols[:-1] + 1))
+    run_starts = np.flatnonzero(new_run)
+    run_stops = np.append(run_starts[1:], len(rows))[:len(run_starts)]
+    run_indices = indices[run_starts]
+    offsets = np.zeros(num_cells + 1, dtype=np.int64)
+    runs_per_cell = np.bincount(run_indices, minlength=max(num_cells, 1))
+    offsets[1:] = np.cumsum(runs_per_cell[:num_cells])
+    return (offsets,
+            rows[run_starts],
+            cols[run_starts],
+            cols[run_stops - 1] + 1)
+
+
+class CellTable(object):
+    """Table of cell properties with array backed columns."""
+
+    def __init__(self, **columns):
+        for name in COLUMNS:
+            setattr(self, name, columns[name])
+        self._index = dict((int(i), n) for n, i in enumerate(self.cell_id))
+
+    @classmethod
+    def from_segmentation(cls, cells):
+        """Return cell table computed from a segmented image.
+
+        The centroid and area are the same as those of the cell regions.
+        The eccentricity, orientation and axis lengths are those of the
+        ellipse with the same second order central moments as the cell, with
+        the orientation measured from the x axis as in scikit-image.
+        """
+        cells = np.asarray(cells)
+        boxes = scipy.ndimage.find_objects(cells)
+        cell_id = np.array([i + 1 for i, box in enumerate(boxes)
+                            if box is not None], dtype=np.int64)
+        num_cells = len(cell_id)
+        index_of_label = np.zeros(len(boxes) + 1, dtype=np.int64)
+        index_of_label[cell_id] = np.arange(num_cells)
+
+        ys, xs = np.nonzero(cells)
+        indices = index_of_label[cells[ys, xs]]
+
+        def per_cell_sum(weights=None):
+            sums = np.bincount(indices, weights, minlength=max(num_cells, 1))
+            return sums[:num_cells]
+
+        area = per_cell_sum()
+        centroid = np.empty((num_cells, 2))
+        centroid[:, 0] = per_cell_sum(ys) / area
+        centroid[:, 1] = per_cell_sum(xs) / area
+
+        # Second order central moments give the long axis of the cells.
+        dy = ys - centroid[indices, 0]
+        dx = xs - centroid[indices, 1]
+        mu_yy = per_cell_sum(dy * dy) / area
+        mu_xx = per_cell_sum(dx * dx) / area
+        mu_xy = per_cell_sum(dy * dx) / area
+        half_sum = (mu_yy + mu_xx) / 2.
+        half_diff = np.sqrt(((mu_yy - mu_xx) / 2.) ** 2 + mu_xy ** 2)
+        major = half_sum + half_diff
+        minor = np.maximum(half_sum - half_diff, 0)
+        eccentricity = np.zeros(num_cells)
+        elongated = major > 0
+        eccentricity[elongated] = np.sqrt(1 - minor[elongated]
+                                          / major[elongated])
+
+        bbox = np.array([(boxes[i - 1][0].start, boxes[i - 1][1].start,
+                          boxes[i - 1][0].stop, boxes[i - 1][1].stop)
+                         for i in cell_id], dtype=np.int64).reshape(-1, 4)
+        offsets, run_rows, run_starts, run_stops = _border_runs(
+            cells, index_of_label, num_cells)
+
+        return cls(cell_id=cell_id,
+                   area=area,
+                   centroid=centroid,
+                   bbox=bbox,
+                   eccentricity=eccentricity,
+                   orientation=0.5 * np.arctan2(-2 * mu_xy, mu_xx - mu_yy),
+                   major_axis_length=4 * np.sqrt(major),
+                   minor_axis_length=4 * np.sqrt(minor),
+                   border_run_offsets=offsets,
+                   border_run_rows=run_rows,
+                   border_run_starts=run_starts,
+                   border_run_stops=run_stops)
+
+    def __len__(self):
+        return len(self.cell_id)
+
+    def index(self, cell_id):
+        """Return row index of a cell."""
+        return self._index[int(cell_id)]
+
+    def bounding_box(self, index):
+        """Return bounding box of a cell as a tuple of slices."""
+        ymin, xmin, ymax, xmax = self.bbox[index]
+        return (slice(ymin, ymax), slice(xmin, xmax))
+
+    def border_mask(self, index, box):
+        """Return boolean array of the border of a cell within a box."""
+        mask = np.zeros((box[0].stop - box[0].start,
+                         box[1].stop - box[1].start), dtype=bool)
+        first = self.border_run_offsets[index]
+        last = self.border_run_offsets[index + 1]
+        for row, start, stop in zip(self.border_run_rows[first:last],
+                                    self.border_run_starts[first:last],
+                                    self.border_run_stops[first:last]):
+            mask[row - box[0].start,
+                 start - box[1].start:stop - box[1].start] = True
+        return mask
+
+
+def test_cell_table():
+    cells = np.array([[0, 0, 0, 0, 0],
+                      [0, 1, 1, 1, 0],
+                      [0, 1, 1, 1, 0],
+                      [0, 1, 1, 1, 3],
+                      [0, 0, 0, 0, 3]])
+    table = CellTable.from_segmentation(cells)
+    assert list(table.cell_id) == [1, 3]
+    assert list(table.area) == [9, 2]
+    assert np.array_equal(table.centroid, [[2, 2], [3.5, 4]])
+    assert list(table.bbox[0]) == [1, 1, 4, 4]
+    assert table.eccentricity[0] == 0
+    assert table.eccentricity[1] == 1
+    box = table.bounding_box(table.index(1))
+    expected = np.ones((3, 3), dtype=bool)
+    expected[1, 1] = False
+    assert np.array_equal(table.border_mask(0, box), expected)
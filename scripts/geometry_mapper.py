@@ -28,10 +28,15 @@ of the region within to original image to the :func:`original_image_point`.
 ...
 (8, 70)
 
+Many points can be converted in one call using :func:`original_image_points`.
+
 """
 
+import sys
 import math
 
+import numpy as np
+
 
 def degrees2radians(rotation):
     """Return rotation in radians."""
@@ -43,6 +48,12 @@ def test_degrees2radians():
     assert degrees2radians(180) == math.pi
 
 
+#: Sines and cosines of the rotations used for the cell images.
+ROTATION_TABLE = dict((degrees, (math.sin(degrees2radians(degrees)),
+                                 math.cos(degrees2radians(degrees))))
+                      for degrees in (0, 90, 180, 270))
+
+
 def relative_to_fraction(rel_dim):
     """Return dim in 0 to 1 scale."""
     return rel_dim + 0.5
@@ -145,6 +156,98 @@ def original_image_point(rel_point, rotation, ydim, xdim,
     return point_as_int(image_point)
 
 
+def _round_half_away_from_zero(values):
+    truncated = np.trunc(values)
+    return truncated + np.sign(values) * (np.abs(values - truncated) >= 0.5)
+
+
+# Python 2 rounds halves away from zero, Python 3 rounds halves to even.
+if sys.version_info[0] < 3:
+    _round = _round_half_away_from_zero
+else:
+    _round = np.rint
+
+
+def points_as_int(points):
+    """Return array of points rounded to integers like :func:`point_as_int`.
+    """
+    return _round(points).astype(np.int64)
+
+
+def test_points_as_int():
+    points = np.array([[4.4, 4.5], [-4.5, 5.5], [-0.5, 0.49999999999999994]])
+    expected = [point_as_int(pt) for pt in points]
+    assert [tuple(pt) for pt in points_as_int(points)] == expected
+
+
+def _sines_and_cosines(rotations):
+    """Return arrays of the sines and cosines of rotations in degrees."""
+    unique, inverse = np.unique(rotations, return_inverse=True)
+    s = np.empty(len(unique))
+    c = np.empty(len(unique))
+    for i, degrees in enumerate(unique.tolist()):
+        if degrees in ROTATION_TABLE:
+            s[i], c[i] = ROTATION_TABLE[degrees]
+        else:
+            rads = degrees2radians(degrees)
+            s[i], c[i] = math.sin(rads), math.cos(rads)
+    return s[inverse], c[inverse]
+
+
+def original_image_points(rel_points, rotations, ydims, xdims,
+                          dy_offsets, dx_offsets):
+    """Return array of points in original image's geometry.
+
+    Gives the same results as calling :func:`original_image_point` for each
+    point.
+
+    :param rel_points: (N, 2) array of points in -0.5 to 0.5 geometry
+    :param rotations: rotation angles in degrees
+    :param ydims: ydims of cropped regions from original image
+    :param xdims: xdims of cropped regions from original image
+    :param dy_offsets: y coordinates of region top left corners
+    :param dx_offsets: x coordinates of region top left corners
+    :returns: (N, 2) integer array of (y, x) points
+    """
+    rel_points = np.asarray(rel_points, dtype=float).reshape(-1, 2)
+    num_points = len(rel_points)
+    rotations = np.broadcast_to(rotations, (num_points,))
+    y = rel_points[:, 0]
+    x = rel_points[:, 1]
+    s, c = _sines_and_cosines(rotations)
+    rot_y = (x * s) + (y * c)
+    rot_x = (x * c) - (y * s)
+    image_points = np.empty((num_points, 2))
+    image_points[:, 0] = (np.asarray(ydims) * relative_to_fraction(rot_y)
+                          + np.asarray(dy_offsets))
+    image_points[:, 1] = (np.asarray(xdims) * relative_to_fraction(rot_x)
+                          + np.asarray(dx_offsets))
+    return points_as_int(image_points)
+
+
+def test_original_image_points():
+    random = np.random.RandomState(0)
+    num_points = 1000
+    rel_points = random.uniform(-0.5, 0.5, (num_points, 2))
+    rel_points[:100] = random.randint(-2, 3, (100, 2)) / 4.
+    rotations = random.choice([0, 90, 180, 270], num_points)
+    rotations[:10] = random.randint(0, 360, 10)
+    ydims = random.randint(50, 300, num_points)
+    xdims = random.randint(50, 300, num_points)
+    dy_offsets = random.randint(-25, 2000, num_points)
+    dx_offsets = random.randint(-25, 2000, num_points)
+    points = original_image_points(rel_points, rotations, ydims, xdims,
+                                   dy_offsets, dx_offsets)
+    for i in range(num_points):
+        expected = original_image_point(tuple(rel_points[i].tolist()),
+                                        int(rotations[i]),
+                                        int(ydims[i]),
+                                        int(xdims[i]),
+                                        int(dy_offsets[i]),
+                                        int(dx_offsets[i]))
+        assert tuple(points[i].tolist()) == expected, i
+
+
 def test_original_image_point():
     im_pt = original_image_point((-0.5, 0), 90, 10, 50, 3, 20)
     assert im_pt == (8, 70), im_pt
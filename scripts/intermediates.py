@@ -0,0 +1,182 @@
+"""Module for writing intermediate images in debug mode.
+
+By default jicbioimage writes the result of every transformation as a png
+image, or a directory of png images for stacks, when ``AutoWrite.on`` is
+set. The results can instead be written as compressed ``.npz`` arrays, with
+or without a downsampled png preview, in a background thread. The
+transformations written can be restricted to a list of names. These are
+set in the parameters file::
+
+    debug_output_format: preview
+    debug_output_stages: [surface_from_stack, project_wall]
+
+The file names are numbered by ``AutoName`` as before, whether or not the
+transformation is written, so that they do not depend on the list of names.
+"""
+
+import atexit
+
+import numpy as np
+
+from jicbioimage.core.io import AutoName, AutoWrite
+from jicbioimage.core.transform import transformation as _transformation
+
+from writer import WriterPool
+
+FORMATS = ["png", "npz", "preview"]
+
+
+class DebugOutput(object):
+    """Settings for writing intermediate images in debug mode."""
+
+    #: One of "png", "npz" or "preview".
+    format = "png"
+
+    #: Names of the transformations to write; None to write all of them.
+    stages = None
+
+    #: Maximum width and height of the preview images.
+    preview_size = 512
+
+    #: Number of transformations being run with AutoWrite switched off.
+    depth = 0
+
+    #: Writer pool for the arrays and previews.
+    writer = None
+
+
+def configure(params):
+    """Set the debug output settings from the parameters."""
+    output_format = params.get("debug_output_format", "png")
+    if output_format not in FORMATS:
+        raise(ValueError("debug_output_format must be one of {}: {}".format(
+            ", ".join(FORMATS), output_format)))
+    DebugOutput.format = output_format
+    DebugOutput.stages = params.get("debug_output_stages")
+
+
+def preview(array, size):
+    """Return downsampled 2D image of an array; stacks are max projected."""
+    array = np.asarray(array)
+    if array.dtype == bool:
+        array = array.astype(np.uint8) * 255
+    if array.ndim == 3:
+        array = array.max(axis=2)
+    step = max(1, int(np.ceil(max(array.shape) / float(size))))
+    return array[::step, ::step]
+
+
+def _writer():
+    if DebugOutput.writer is None:
+        # Few pending writes, as each holds a copy of a full-size result.
+        DebugOutput.writer = WriterPool(threads=2, max_pending=4)
+    return DebugOutput.writer
+
+
+def flush():
+    """Wait for the pending writes to finish."""
+    if DebugOutput.writer is not None:
+        writer = DebugOutput.writer
+        DebugOutput.writer = None
+        writer.close()
+
+
+atexit.register(flush)
+
+
+def write(fpath, image):
+    """Write an intermediate image in the debug output format."""
+    if DebugOutput.format == "png":
+        image.write(fpath)
+        return
+    writer = _writer()
+
+    # The image may be modified in place by the next transformation.
+    writer.write_npz(fpath + ".npz", np.array(image))
+    if DebugOutput.format == "preview":
+        writer.write_png(fpath + "-preview.png",
+                         preview(image, DebugOutput.preview_size))
+
+
+def wrap(transform):
+    """Return jicbioimage transformation written in the debug output format.
+
+    :param transform: function decorated with the jicbioimage
+                      ``transformation`` decorator
+    """
+    name = transform.__name__
+
+    def debug_output_transformation(*args, **kwargs):
+        if DebugOutput.depth == 0 and (not AutoWrite.on or (
+                DebugOutput.format == "png" and DebugOutput.stages is None)):
+            return transform(*args, **kwargs)
+
+        # Switch off AutoWrite so that the transformation is written here.
+        AutoWrite.on = False
+        DebugOutput.depth += 1
+        try:
+            image = transform(*args, **kwargs)
+        finally:
+            DebugOutput.depth -= 1
+            if DebugOutput.depth == 0:
+                AutoWrite.on = True
+        fpath = AutoName.name(transform)
+        if DebugOutput.stages is None or name in DebugOutput.stages:
+            write(fpath, image)
+        return image
+    debug_output_transformation.__name__ = name
+    debug_output_transformation.__doc__ = transform.__doc__
+    return debug_output_transformation
+
+
+def transformation(func):
+    """Function decorator to turn a function into a transformation.
+
+    Like the jicbioimage decorator, but the result is written in the debug
+    output format.
+    """
+    return wrap(_transformation(func))
+
+
+def test_wrap():
+    import os
+    import shutil
+    import tempfile
+
+    @transformation
+    def double(image):
+        return image * 2
+
+    @transformation
+    def quadruple(image):
+        return double(double(image))
+
+    directory = tempfile.mkdtemp()
+    settings = (AutoName.directory, AutoName.count, AutoName.prefix_format,
+                AutoWrite.on)
+    try:
+        AutoName.directory = directory
+        AutoName.count = 0
+        AutoName.prefix_format = "{:d}_"
+        AutoWrite.on = True
+        DebugOutput.format = "preview"
+        DebugOutput.stages = ["quadruple"]
+        image = np.arange(12, dtype=np.uint8).reshape((3, 4))
+        assert np.array_equal(quadruple(image), image * 4)
+        assert AutoWrite.on
+        flush()
+        assert sorted(os.listdir(directory)) == ["3_quadruple-preview.png",
+                                                 "3_quadruple.npz"]
+        with np.load(os.path.join(directory, "3_quadruple.npz")) as npz:
+            assert np.array_equal(npz["image"], image * 4)
+    finally:
+        (AutoName.directory, AutoName.count, AutoName.prefix_format,
+         AutoWrite.on) = settings
+        DebugOutput.format = "png"
+        DebugOutput.stages = None
+        shutil.rmtree(directory)
+
+    stack = np.zeros((10, 6, 3), dtype=np.uint8)
+    stack[4, 2, 1] = 7
+    assert preview(stack, 5).shape == (5, 3)
+    assert preview(stack, 5)[2, 1] == 7
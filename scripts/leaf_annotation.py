@@ -3,73 +3,53 @@
 import argparse
 import os
 import logging
-import json
 
 from jicbioimage.core.io import AutoWrite
-from jicbioimage.illustrate import AnnotatedImage
 
-from utils import get_microscopy_collection
+from utils import UnpackedIndex
+from profiling import Profiling
 from parameters import Parameters
-from surface import surface_from_stack
-from projection import (
-    project_wall,
-    project_marker,
-)
-from geometry_mapper import original_image_point
+from pipeline import leaf_surface_and_projections
+from annotation import leaf_views
+from cellstore import tagged_celldata, json_fpath
+from tensor_csv import marker_points
 
 
 __version__ = "0.1.0"
 
 
-def save_annotated_leaf(input_dir, input_image, output_file, random, **kwargs):
-    """Write out annotated leaf image."""
-    microscopy_collection = get_microscopy_collection(input_image)
-
-    wall_stack = microscopy_collection.zstack(c=kwargs["wall_channel"])
-    surface = surface_from_stack(wall_stack, **kwargs)
-    wall_projection = project_wall(wall_stack, surface, **kwargs)
-
-    marker_stack = microscopy_collection.zstack(c=kwargs["marker_channel"])
-    # Refactor with analysis script to ensure always in sync.
-    marker_projection = project_marker(marker_stack, surface, **kwargs)
-
-    wall_ann = AnnotatedImage.from_grayscale(wall_projection, (1, 0, 0))
-    marker_ann = AnnotatedImage.from_grayscale(marker_projection, (0, 1, 0))
-    ann = wall_ann + marker_ann
-
-    json_fpaths = [os.path.join(input_dir, f)
-                   for f in os.listdir(input_dir)
-                   if f.endswith(".json")]
-
-    y_key = "normalised_marker_y_coord"
-    x_key = "normalised_marker_x_coord"
-    for fpath in json_fpaths:
-        with open(fpath) as fh:
-            celldata = json.load(fh)
-
-        if y_key not in celldata:
-            continue
-        if x_key not in celldata:
-            continue
-        print(fpath)
-        frac_pt = celldata[y_key], celldata[x_key]
-        rel_pt = tuple([i - 0.5 for i in frac_pt])
-
-        rotation = celldata["rotation"]
-        if random:
-            rotation = 0
-        marker_pt = original_image_point(rel_point=rel_pt,
-                                         rotation=rotation,
-                                         ydim=celldata["ydim"],
-                                         xdim=celldata["xdim"],
-                                         dy_offset=celldata["dy_offset"],
-                                         dx_offset=celldata["dx_offset"])
-
+def draw_tagged_cells(ann, tagged, points):
+    """Draw lines from the centroids to the marker points of tagged cells."""
+    for celldata, marker_pt in zip(tagged, points):
         ann.draw_line(marker_pt, celldata["centroid"], (255, 255, 255))
         ann.draw_cross(celldata["centroid"], (255, 255, 255))
 
+
+def write_annotated_leaf(output_file, leaf, tagged, points):
+    """Write out leaf image annotated with tagged cells and marker points.
+
+    :param leaf: combined wall and marker image, which is not modified
+    :returns: annotated leaf image
+    """
+    ann = leaf.copy()
+    draw_tagged_cells(ann, tagged, points)
+
     with open(output_file, "wb") as fh:
         fh.write(ann.png())
+    return ann
+
+
+def save_annotated_leaf(input_dir, input_image, output_file, random, **kwargs):
+    """Write out annotated leaf image."""
+    surface, wall_projection, marker_projection = \
+        leaf_surface_and_projections(input_image, **kwargs)
+    leaf = leaf_views(wall_projection, marker_projection)[2]
+
+    tagged = tagged_celldata(input_dir)
+    for celldata in tagged:
+        print(json_fpath(input_dir, celldata["cell_id"]))
+    write_annotated_leaf(output_file, leaf, tagged,
+                         marker_points(tagged, random))
 
 def main():
     # Parse the command line arguments.
@@ -79,6 +59,10 @@ def main():
     parser.add_argument("parameters_file", help="Parameters file")
     parser.add_argument("output_file", help="Output file")
     parser.add_argument("--random", action="store_true", help="Use random rotation")
+    parser.add_argument("--verify", default=False, action="store_true",
+                        help="Hash input image instead of trusting the index")
+    parser.add_argument("--profile", default=False, action="store_true",
+                        help="Log time and memory use of every stage")
     args = parser.parse_args()
 
     # Check that the input directory and files exists.
@@ -92,6 +76,14 @@ def main():
     # Read in the parameters.
     params = Parameters.from_file(args.parameters_file)
 
+    # Check that the input image has not changed since it was unpacked.
+    if args.verify:
+        UnpackedIndex.verify = True
+
+    # Log the time and memory use of the transformations.
+    if args.profile:
+        Profiling.on = True
+
     # Don't write out intermediate images.
     AutoWrite.on = False
 
@@ -0,0 +1,234 @@
+"""Module for generating the surface and projections of a leaf.
+
+By default the surface and projections are computed from the whole stacks.
+If ``memory_budget_mb`` is set in the parameters the stacks are instead
+processed in tiles of rows, sized so that the working memory of each tile
+stays within the budget. The tiled results are identical to the untiled ones.
+Unless intermediate images are being written, the stacks are then decoded
+plane by plane into temporary memory-mapped volumes next to the unpacked
+images, so that the whole stacks are never held in memory and each plane is
+only decoded once.
+
+Stacks with a memory-mapped volume in the backend, see
+:class:`utils.MappedMicroscopyCollection`, are read from the volume rather
+than decoded plane by plane.
+
+The results for an input file are cached on disk, keyed on the input file
+and the parameters that affect them, so that all entry points share them.
+"""
+
+import logging
+
+import numpy as np
+
+from jicbioimage.core.io import AutoWrite
+
+import cache
+from cache import ArtifactCache
+from profiling import transformation
+from utils import (
+    get_microscopy_collection,
+    unpacked_md5_hexdigest,
+    lazy_zstack,
+    LazyZStack,
+)
+from surface import surface_from_stack, surface_dtype, _surface
+from projection import (
+    project_wall,
+    project_marker,
+    _filter_halo,
+    _project,
+    _project_filtered_tile,
+    _remove_noise,
+)
+
+#: Parameters that affect the surface and projections.
+ARTIFACT_PARAMS = [
+    "wall_channel",
+    "marker_channel",
+    "surface_percentile",
+    "wall_percentile_filter_percentile",
+    "wall_percentile_filter_size",
+    "wall_zabove",
+    "wall_zbelow",
+    "marker_zabove",
+    "marker_zbelow",
+    "marker_min_intensity",
+]
+
+#: Version of the surface and projection code, part of the cache keys.
+#: Bump it whenever a change alters the cached surface or projections.
+ARTIFACT_VERSION = 1
+
+ARTIFACT_NAMES = ["surface", "wall_projection", "marker_projection"]
+
+
+@transformation
+def identity(image):
+    """Return the image as is."""
+    return image
+
+
+def tile_rows(shape, itemsize, memory_budget_mb, halo=0):
+    """Return number of rows per tile to stay within the memory budget.
+
+    The estimate allows for the copies made per row of a tile: the
+    partitioned stack and surface mask, the filtered z-band and its input
+    and a few per-pixel float arrays.
+    """
+    ydim, xdim, zdim = shape
+    bytes_per_row = xdim * (zdim * (3 * itemsize + 1) + 4 * 8)
+    budget = memory_budget_mb * 1024 * 1024
+    return max(1, int(budget // bytes_per_row) - 2 * halo)
+
+
+def _tiles(ydim, rows):
+    """Yield start and stop rows of the tiles."""
+    for y0 in range(0, ydim, rows):
+        yield y0, min(y0 + rows, ydim)
+
+
+@transformation
+def tiled_surface_from_stack(wall_stack, rows, **kwargs):
+    """Return surface computed in tiles; see surface_from_stack."""
+    ydim, xdim, zdim = wall_stack.shape
+    surface = np.zeros((ydim, xdim), dtype=surface_dtype(zdim))
+    for y0, y1 in _tiles(ydim, rows):
+        surface[y0:y1] = _surface(wall_stack[y0:y1],
+                                  kwargs["surface_percentile"])
+    return surface
+
+
+@transformation
+def tiled_project_wall(wall_stack, surface, rows, **kwargs):
+    """Return wall projection computed in tiles; see project_wall."""
+    wall_projection = np.zeros(surface.shape, dtype=np.uint8)
+    for y0, y1 in _tiles(surface.shape[0], rows):
+        wall_projection[y0:y1] = _project_filtered_tile(
+            wall_stack,
+            surface[y0:y1],
+            y0,
+            kwargs["wall_percentile_filter_percentile"],
+            kwargs["wall_percentile_filter_size"],
+            zabove=kwargs["wall_zabove"],
+            zbelow=kwargs["wall_zbelow"],
+            proj_method=np.mean)
+    return wall_projection
+
+
+@transformation
+def tiled_project_marker(marker_stack, surface, rows, **kwargs):
+    """Return marker projection computed in tiles; see project_marker."""
+    marker_projection = np.zeros(surface.shape, dtype=np.uint8)
+    for y0, y1 in _tiles(surface.shape[0], rows):
+        marker_projection[y0:y1] = _project(np.asarray(marker_stack[y0:y1]),
+                                            surface[y0:y1],
+                                            kwargs["marker_zabove"],
+                                            kwargs["marker_zbelow"],
+                                            np.max)
+    return _remove_noise(marker_projection, kwargs["marker_min_intensity"])
+
+
+def stack_tile_rows(stack, **kwargs):
+    """Return number of rows per tile of a stack within the memory budget."""
+    return tile_rows(stack.shape,
+                     stack.dtype.itemsize,
+                     kwargs["memory_budget_mb"],
+                     halo=_filter_halo(kwargs["wall_percentile_filter_size"]))
+
+
+def tiled_surface_and_projections(wall_stack, marker_stack, **kwargs):
+    """Return surface, wall and marker projections computed in tiles."""
+    rows = stack_tile_rows(wall_stack, **kwargs)
+    logging.info("Processing stacks in tiles of {} rows".format(rows))
+    surface = tiled_surface_from_stack(wall_stack, rows, **kwargs)
+    wall_projection = tiled_project_wall(wall_stack, surface, rows, **kwargs)
+    marker_projection = tiled_project_marker(marker_stack, surface, rows,
+                                             **kwargs)
+    return surface, wall_projection, marker_projection
+
+
+def surface_and_projections(wall_stack, marker_stack, **kwargs):
+    """Return surface, wall and marker projections."""
+    if kwargs.get("memory_budget_mb"):
+        return tiled_surface_and_projections(wall_stack, marker_stack,
+                                             **kwargs)
+    surface = surface_from_stack(wall_stack, **kwargs)
+    wall_projection = project_wall(wall_stack, surface, **kwargs)
+    marker_projection = project_marker(marker_stack, surface, **kwargs)
+    return surface, wall_projection, marker_projection
+
+
+def leaf_surface_and_projections(fpath, **kwargs):
+    """Return surface, wall and marker projections of a leaf image file.
+
+    The results are read from the artifact cache if present. The cache is
+    bypassed when intermediate images are being written.
+    """
+    use_cache = ArtifactCache.on and not AutoWrite.on
+    if use_cache:
+        key = cache.artifact_key(unpacked_md5_hexdigest(fpath),
+                                 kwargs,
+                                 ARTIFACT_PARAMS,
+                                 ARTIFACT_VERSION)
+        artifacts = cache.load(key, ARTIFACT_NAMES)
+        if artifacts is not None:
+            logging.info("Using cached surface and projections")
+            return artifacts
+
+    microscopy_collection = get_microscopy_collection(fpath)
+    if kwargs.get("memory_budget_mb") and not AutoWrite.on:
+        # Don't hold the whole stacks in memory.
+        wall_stack = lazy_zstack(microscopy_collection,
+                                 c=kwargs["wall_channel"])
+        marker_stack = lazy_zstack(microscopy_collection,
+                                   c=kwargs["marker_channel"])
+    else:
+        wall_stack = microscopy_collection.zstack(c=kwargs["wall_channel"])
+        wall_stack = identity(wall_stack)
+        marker_stack = microscopy_collection.zstack(c=kwargs["marker_channel"])
+        marker_stack = identity(marker_stack)
+    artifacts = surface_and_projections(wall_stack, marker_stack, **kwargs)
+
+    if use_cache:
+        cache.save(key,
+                   max_size_mb=kwargs.get("artifact_cache_max_size_mb"),
+                   **dict(zip(ARTIFACT_NAMES, artifacts)))
+    return artifacts
+
+
+def test_tiled_surface_and_projections():
+    params = dict(surface_percentile=75,
+                  wall_percentile_filter_percentile=95,
+                  wall_percentile_filter_size=2,
+                  wall_zabove=-3,
+                  wall_zbelow=6,
+                  marker_zabove=0,
+                  marker_zbelow=4,
+                  marker_min_intensity=20)
+    random = np.random.RandomState(0)
+    wall_stack = random.randint(0, 255, (30, 20, 12)).astype(np.uint8)
+    marker_stack = random.randint(0, 255, (30, 20, 12)).astype(np.uint8)
+    expected = surface_and_projections(wall_stack, marker_stack, **params)
+    params["memory_budget_mb"] = 0.01
+    actual = surface_and_projections(wall_stack, marker_stack, **params)
+    for e, a in zip(expected, actual):
+        assert np.array_equal(e, a)
+
+    class ArrayZStack(LazyZStack):
+        def _read_plane(self, z):
+            return self._fpaths[z]
+
+    # Each plane is decoded once, however many tiles there are.
+    lazy_wall_stack = ArrayZStack([wall_stack[:, :, z] for z in range(12)])
+    lazy_marker_stack = ArrayZStack([marker_stack[:, :, z]
+                                     for z in range(12)])
+    actual = surface_and_projections(lazy_wall_stack.to_volume(),
+                                     lazy_marker_stack.to_volume(),
+                                     **params)
+    for e, a in zip(expected, actual):
+        assert np.array_equal(e, a)
+    assert tile_rows(wall_stack.shape, 1, params["memory_budget_mb"],
+                     halo=_filter_halo(2)) < 10
+    assert lazy_wall_stack.num_reads == 12
+    assert lazy_marker_stack.num_reads == 12
@@ -1,36 +1,289 @@
-"""Script for generating annotated leaf."""
+"""Script for generating annotated leaf.
+
+By default only the cells tagged since the previous run are processed. The
+state of the cells, i.e. the modification time, size and hash of their json
+files and their mapped marker points, is recorded in a state file in the
+leaf directory. Newly tagged cells are drawn onto cached copies of the
+annotated leaf images and appended to the csv files. If a previously tagged
+cell has changed, or the leaf image or its parameters have, the outputs are
+rebuilt; use ``--full`` to force a rebuild.
+"""
 
 import argparse
 import os
+import json
+import logging
+import hashlib
+import tempfile
+
+import numpy as np
 
 from jicbioimage.core.io import AutoWrite
+from jicbioimage.illustrate import AnnotatedImage
 
+import cache
+from utils import UnpackedIndex, unpacked_md5_hexdigest
+from profiling import Profiling
 from parameters import Parameters
-from leaf_annotation import save_annotated_leaf
-from tensor_csv import write_csv
+from pipeline import (
+    leaf_surface_and_projections,
+    ARTIFACT_PARAMS,
+    ARTIFACT_VERSION,
+)
+from annotation import leaf_views
+from cellstore import STORE_FNAME, TAG_KEYS, json_fpaths, read_store
+from leaf_annotation import draw_tagged_cells, write_annotated_leaf
+from tensor_csv import marker_points, write_tensors, append_tensors
+
+
+__version__ = "0.2.0"
+
+STATE_FNAME = "post-tagging-state.json"
+STATE_VERSION = 2
+CACHE_DNAME = "post-tagging-cache"
+
+#: Marker point key, whether the rotation is ignored and output suffix.
+OUTPUTS = [("marker", False, ""), ("marker_random", True, "-random")]
+
+
+def _sha1(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def read_state(input_dir):
+    """Return state of the previous run, or None."""
+    fpath = os.path.join(input_dir, STATE_FNAME)
+    if not os.path.isfile(fpath):
+        return None
+    with open(fpath) as fh:
+        state = json.load(fh)
+    if state.get("version") != STATE_VERSION:
+        return None
+    return state
 
 
-__version__ = "0.1.0"
+def write_state(input_dir, state):
+    """Write state of the run atomically."""
+    fd, tmp_fpath = tempfile.mkstemp(dir=input_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as fh:
+        json.dump(state, fh)
+    os.rename(tmp_fpath, os.path.join(input_dir, STATE_FNAME))
 
 
-def post_tagging_processing(input_dir, input_image, params):
+def scan_cells(ann_cells_dir, previous):
+    """Yield (key, entry, celldata) of the cells in the order of the outputs.
+
+    The json files whose modification time and size are unchanged since the
+    previous run are not read; their entry is the previous one and their
+    celldata is None. The cells in a cell store are always read.
+    """
+    store_fpath = os.path.join(ann_cells_dir, STORE_FNAME)
+    if os.path.isfile(store_fpath):
+        for celldata in read_store(ann_cells_dir):
+            key = "cell-{:05d}".format(celldata["cell_id"])
+            text = json.dumps(celldata, sort_keys=True)
+            yield key, dict(mtime=None, size=None, sha1=_sha1(text)), celldata
+        return
+
+    for fpath in json_fpaths(ann_cells_dir):
+        key = os.path.splitext(os.path.basename(fpath))[0]
+        st = os.stat(fpath)
+        prev = previous.get(key)
+        if (prev is not None and prev["mtime"] == st.st_mtime
+                and prev["size"] == st.st_size):
+            yield key, prev, None
+            continue
+        with open(fpath) as fh:
+            text = fh.read()
+        entry = dict(mtime=st.st_mtime, size=st.st_size, sha1=_sha1(text))
+        yield key, entry, json.loads(text)
+
+
+def _write_png(fpath, ann):
+    with open(fpath, "wb") as fh:
+        fh.write(ann.png())
+
+
+def post_tagging_processing(input_dir, input_image, params, full=False,
+                            md5_hexdigest=unpacked_md5_hexdigest,
+                            surface_and_projections=(
+                                leaf_surface_and_projections)):
+    """Write annotated leaf images and tensor csv files of a leaf.
+
+    The tagged cells and the leaf image are read once and shared by the
+    outputs for the true and the random, i.e. zero, rotations.
+
+    :param full: rebuild the outputs even if only new cells were tagged
+    :param md5_hexdigest: function returning the hash of the input image
+    :param surface_and_projections: function returning the surface, wall
+                                    and marker projections of the input
+                                    image
+    """
     ann_cells_dir = os.path.join(input_dir, "annotated-cells")
-    save_annotated_leaf(ann_cells_dir,
-                        input_image,
-                        os.path.join(input_dir, "annotated-leaf.png"),
-                        random=False,
-                        **params)
-    save_annotated_leaf(ann_cells_dir,
-                        input_image,
-                        os.path.join(input_dir, "annotated-leaf-random.png"),
-                        random=True,
-                        **params)
-    write_csv(ann_cells_dir,
-              os.path.join(input_dir, "tensors.csv"),
-              random=False)
-    write_csv(ann_cells_dir,
-              os.path.join(input_dir, "tensors-random.csv"),
-              random=True)
+    cache_dir = os.path.join(input_dir, CACHE_DNAME)
+    leaf_key = cache.artifact_key(md5_hexdigest(input_image),
+                                  params,
+                                  ARTIFACT_PARAMS,
+                                  ARTIFACT_VERSION)
+
+    # The outputs are only updated in place if all of them still exist.
+    required_fpaths = [os.path.join(cache_dir, "leaf.npy")]
+    for _, _, suffix in OUTPUTS:
+        required_fpaths.extend([
+            os.path.join(cache_dir, "annotated-leaf{}.npy".format(suffix)),
+            os.path.join(input_dir, "annotated-leaf{}.png".format(suffix)),
+            os.path.join(input_dir, "tensors{}.csv".format(suffix))])
+
+    state = None
+    if not full:
+        state = read_state(input_dir)
+    if state is not None and (state["leaf_key"] != leaf_key or not all(
+            [os.path.isfile(fpath) for fpath in required_fpaths])):
+        state = None
+    rebuild = state is None
+    previous = {}
+    previous_tagged = []
+    if not rebuild:
+        previous = state["cells"]
+        previous_tagged = state["tagged"]
+
+    # Find the new and changed cells.
+    keys = []
+    cells = {}
+    pending = []
+    redraw = rebuild
+    for key, entry, celldata in scan_cells(ann_cells_dir, previous):
+        prev = previous.get(key)
+        if celldata is not None:
+            entry["cell_id"] = celldata["cell_id"]
+            if prev is not None and prev["sha1"] == entry["sha1"]:
+                entry = dict(prev, mtime=entry["mtime"], size=entry["size"])
+            else:
+                if prev is not None and prev["tagged"]:
+                    redraw = True
+                entry["tagged"] = all([k in celldata for k in TAG_KEYS])
+                if entry["tagged"]:
+                    entry["centroid"] = celldata["centroid"]
+                    pending.append((entry, celldata))
+        keys.append(key)
+        cells[key] = entry
+    for key in previous_tagged:
+        if key not in cells:
+            redraw = True
+
+    # Map the marker points of the new and changed cells.
+    pending_celldata = [celldata for _, celldata in pending]
+    for name, random, _ in OUTPUTS:
+        points = marker_points(pending_celldata, random)
+        for (entry, _), point in zip(pending, points):
+            entry[name] = list(point)
+
+    # Newly tagged cells that come after all the previously tagged cells
+    # can be added to the outputs, otherwise the outputs are rebuilt.
+    tagged = sorted([key for key in keys if cells[key]["tagged"]],
+                    key=lambda key: cells[key]["cell_id"])
+    if tagged[:len(previous_tagged)] != previous_tagged:
+        redraw = True
+    added = tagged[len(previous_tagged):]
+    if redraw:
+        added = tagged
+    state = dict(version=STATE_VERSION,
+                 leaf_key=leaf_key,
+                 cells=cells,
+                 tagged=tagged)
+    if not redraw and len(added) == 0:
+        write_state(input_dir, state)
+        return
+
+    # Remove the state while the outputs are updated, so that an
+    # interrupted run is followed by a full rebuild.
+    state_fpath = os.path.join(input_dir, STATE_FNAME)
+    if os.path.isfile(state_fpath):
+        os.remove(state_fpath)
+    if not os.path.isdir(cache_dir):
+        os.mkdir(cache_dir)
+    leaf_fpath = os.path.join(cache_dir, "leaf.npy")
+    if rebuild:
+        surface, wall_projection, marker_projection = \
+            surface_and_projections(input_image, **params)
+        leaf = leaf_views(wall_projection, marker_projection)[2]
+        np.save(leaf_fpath, leaf)
+    elif redraw:
+        leaf = np.load(leaf_fpath).view(AnnotatedImage)
+
+    added_entries = [cells[key] for key in added]
+    for name, random, suffix in OUTPUTS:
+        points = [tuple(entry[name]) for entry in added_entries]
+        png_fpath = os.path.join(input_dir,
+                                 "annotated-leaf{}.png".format(suffix))
+        csv_fpath = os.path.join(input_dir, "tensors{}.csv".format(suffix))
+        ann_fpath = os.path.join(cache_dir,
+                                 "annotated-leaf{}.npy".format(suffix))
+        if redraw:
+            ann = write_annotated_leaf(png_fpath, leaf, added_entries, points)
+            write_tensors(csv_fpath, added_entries, points)
+        else:
+            ann = np.load(ann_fpath).view(AnnotatedImage)
+            draw_tagged_cells(ann, added_entries, points)
+            _write_png(png_fpath, ann)
+            append_tensors(csv_fpath, added_entries, points,
+                           first_identifier=len(previous_tagged) + 1)
+        np.save(ann_fpath, ann)
+
+    write_state(input_dir, state)
+
+
+def test_post_tagging_processing_missing_output():
+    import shutil
+
+    def md5_hexdigest(input_image):
+        return "0" * 32
+
+    def surface_and_projections(input_image, **kwargs):
+        projection = np.zeros((60, 80), dtype=np.uint8)
+        return projection, projection, projection
+
+    def run(input_dir):
+        post_tagging_processing(input_dir, "leaf.lif", Parameters(),
+                                md5_hexdigest=md5_hexdigest,
+                                surface_and_projections=(
+                                    surface_and_projections))
+
+    def write_cell(ann_cells_dir, cell_id, tagged):
+        celldata = dict(cell_id=cell_id, centroid=[10.5, 20.0], area=4,
+                        dy_offset=0, dx_offset=10, ydim=20, xdim=40,
+                        rotation=90)
+        if tagged:
+            celldata.update(normalised_marker_y_coord=0.,
+                            normalised_marker_x_coord=0.5)
+        fname = "cell-{:05d}.json".format(cell_id)
+        with open(os.path.join(ann_cells_dir, fname), "w") as fh:
+            json.dump(celldata, fh)
+
+    def read_lines(fpath):
+        with open(fpath) as fh:
+            return fh.read().split("\n")
+
+    input_dir = tempfile.mkdtemp()
+    try:
+        ann_cells_dir = os.path.join(input_dir, "annotated-cells")
+        os.mkdir(ann_cells_dir)
+        write_cell(ann_cells_dir, 2, tagged=True)
+        write_cell(ann_cells_dir, 12, tagged=False)
+        run(input_dir)
+        csv_fpath = os.path.join(input_dir, "tensors.csv")
+        assert read_lines(csv_fpath) == ["id,mx,my,cx,cy",
+                                         "1,50,10,20.0,10.5"]
+
+        # A deleted csv file is written again with all the tagged cells.
+        os.remove(csv_fpath)
+        write_cell(ann_cells_dir, 12, tagged=True)
+        run(input_dir)
+        assert read_lines(csv_fpath) == ["id,mx,my,cx,cy",
+                                         "1,50,10,20.0,10.5",
+                                         "2,50,10,20.0,10.5"]
+    finally:
+        shutil.rmtree(input_dir)
 
 
 def main():
@@ -39,6 +292,12 @@ def main():
     parser.add_argument("input_dir", help="Leaf directory")
     parser.add_argument("input_image", help="Input image")
     parser.add_argument("parameters_file", help="Parameters file")
+    parser.add_argument("--verify", default=False, action="store_true",
+                        help="Hash input image instead of trusting the index")
+    parser.add_argument("--full", default=False, action="store_true",
+                        help="Rebuild outputs from all tagged cells")
+    parser.add_argument("--profile", default=False, action="store_true",
+                        help="Log time and memory use of every stage")
     args = parser.parse_args()
 
     # Check that the input directory and files exists.
@@ -52,11 +311,31 @@ def main():
     # Read in the parameters.
     params = Parameters.from_file(args.parameters_file)
 
+    # Check that the input image has not changed since it was unpacked.
+    if args.verify:
+        UnpackedIndex.verify = True
+
+    # Log the time and memory use of the transformations.
+    if args.profile:
+        Profiling.on = True
+
     # Don't write out intermediate images.
     AutoWrite.on = False
 
+    # Setup a logger for the script, next to that of the analysis.
+    log_fname = "audit.log"
+    log_fpath = os.path.join(args.input_dir, log_fname)
+    logging_level = logging.INFO
+    logging.basicConfig(filename=log_fpath, level=logging_level)
+
+    # Log some basic information about the script that is running.
+    logging.info("Script name: {}".format(__file__))
+    logging.info("Script version: {}".format(__version__))
+    logging.info("Parameters: {}".format(params))
+
     # Run the post tagging processing.
-    post_tagging_processing(args.input_dir, args.input_image, params)
+    post_tagging_processing(args.input_dir, args.input_image, params,
+                            full=args.full)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,147 @@
+"""Module for profiling the image transformations.
+
+Use :func:`transformation` from this module instead of the jicbioimage one;
+it also writes intermediate images as set up in :mod:`intermediates`.
+When ``Profiling.on`` is set every call of a transformation is logged as a
+json object on a line starting with ``Profile:``, e.g. in ``audit.log``::
+
+    INFO:root:Profile: {"cpu_seconds": 0.41, "depth": 0, ...}
+
+The record holds the name of the transformation, its wall and CPU time, the
+increase of the peak resident set size of the process during the call and
+the shape and dtype of its input and output image. Transformations called
+by other transformations have a depth greater than zero; the times of the
+outer transformation include theirs.
+"""
+
+import json
+import logging
+import resource
+from functools import wraps
+from time import time
+
+from intermediates import transformation as _transformation
+
+PREFIX = "Profile: "
+
+
+class Profiling(object):
+    """Settings for profiling the transformations."""
+
+    #: Whether or not the transformations are profiled.
+    on = False
+
+    #: Number of profiled transformations currently running.
+    depth = 0
+
+
+def _describe(array):
+    """Return dictionary with the shape and dtype of an array."""
+    shape = getattr(array, "shape", None)
+    dtype = getattr(array, "dtype", None)
+    return dict(shape=None if shape is None else list(shape),
+                dtype=None if dtype is None else str(dtype))
+
+
+def _usage():
+    """Return wall time, CPU time and peak resident set size in MB."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    # Linux reports the peak resident set size in kilobytes.
+    return time(), usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024.
+
+
+def transformation(func):
+    """Function decorator to turn a function into a profiled transformation.
+
+    The function becomes a jicbioimage transformation, which is profiled
+    when ``Profiling.on`` is set.
+    """
+    transform = _transformation(func)
+
+    @wraps(func)
+    def profiled_transformation(*args, **kwargs):
+        if not Profiling.on:
+            return transform(*args, **kwargs)
+
+        input_image = kwargs.get("image", args[0] if args else None)
+        depth = Profiling.depth
+        Profiling.depth += 1
+        start_wall, start_cpu, start_rss = _usage()
+        try:
+            image = transform(*args, **kwargs)
+        finally:
+            Profiling.depth -= 1
+        wall, cpu, rss = _usage()
+
+        record = dict(transformation=func.__name__,
+                      depth=depth,
+                      wall_seconds=round(wall - start_wall, 4),
+                      cpu_seconds=round(cpu - start_cpu, 4),
+                      peak_rss_increase_mb=round(rss - start_rss, 1),
+                      input=_describe(input_image),
+                      output=_describe(image))
+        logging.info(PREFIX + json.dumps(record, sort_keys=True))
+        return image
+    return profiled_transformation
+
+
+def read_profile(fpath):
+    """Return list of the profile records in a log file."""
+    records = []
+    with open(fpath) as fh:
+        for line in fh:
+            _, sep, text = line.partition(PREFIX)
+            if sep:
+                records.append(json.loads(text))
+    return records
+
+
+def test_transformation():
+    import numpy as np
+
+    from jicbioimage.core.io import AutoWrite
+
+    class ListHandler(logging.Handler):
+        def __init__(self):
+            logging.Handler.__init__(self)
+            self.messages = []
+
+        def emit(self, record):
+            self.messages.append(record.getMessage())
+
+    @transformation
+    def double(image):
+        return image * 2
+
+    @transformation
+    def quadruple(image):
+        return double(double(image))
+
+    handler = ListHandler()
+    logger = logging.getLogger()
+    logger.addHandler(handler)
+    level = logger.level
+    logger.setLevel(logging.INFO)
+    auto_write = AutoWrite.on
+    AutoWrite.on = False
+    try:
+        image = np.ones((3, 4), dtype=np.uint8)
+        assert np.array_equal(quadruple(image), image * 4)
+        assert handler.messages == []
+
+        Profiling.on = True
+        quadruple(image)
+    finally:
+        Profiling.on = False
+        AutoWrite.on = auto_write
+        logger.setLevel(level)
+        logger.removeHandler(handler)
+
+    records = [json.loads(m[len(PREFIX):]) for m in handler.messages]
+    assert [r["transformation"] for r in records] == ["double", "double",
+                                                      "quadruple"]
+    assert [r["depth"] for r in records] == [1, 1, 0]
+    assert records[2]["input"] == dict(shape=[3, 4], dtype="uint8")
+    assert records[2]["output"] == dict(shape=[3, 4], dtype="uint8")
+    assert records[2]["wall_seconds"] >= records[0]["wall_seconds"]
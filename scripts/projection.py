@@ -4,28 +4,106 @@ import numpy as np
 import scipy.ndimage as nd
 
 from jicbioimage.core.image import Image
-from jicbioimage.core.transform import transformation
+
+from profiling import transformation
+
+
+def _window_bounds(surface, zabove, zbelow, zdim):
+    """Return clamped z-window start and stop indices for every pixel."""
+    z_index = np.asarray(surface).astype(np.int64)
+    z_min = np.clip(z_index - zabove, 0, zdim - 1)
+    z_max = np.minimum(z_index + 1 + zbelow, zdim)
+    z_max = np.maximum(z_max, z_min + 1)
+    return z_min, z_max
+
+
+def _reduce_windows(columns, z_min, z_max, proj_method):
+    """Return uint8 reduction of every column between z_min and z_max."""
+    projection = np.zeros(z_min.shape, dtype=np.uint8)
+    if projection.size == 0:
+        return projection
+
+    # The window only depends on the surface depth, so pixels are grouped by
+    # window and each group is reduced in one call.
+    key = z_min * (int(z_max.max()) + 1) + z_max
+    order = np.argsort(key, kind="mergesort")
+    sorted_key = key[order]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(sorted_key)) + 1))
+    stops = np.concatenate((starts[1:], [len(order)]))
+    for start, stop in zip(starts, stops):
+        indices = order[start:stop]
+        first = indices[0]
+        window = columns[indices, z_min[first]:z_max[first]]
+        projection[indices] = proj_method(window, axis=1)
+    return projection
 
 
 def _project(stack, surface, zabove, zbelow, proj_method):
+    """Return projection of the stack in a z-window around the surface.
+
+    The proj_method is any numpy style reducer, e.g. np.mean or np.max, that
+    accepts an ``axis`` keyword argument. It is called with a 2D array with
+    one z-window per row.
+    """
+    zdim = stack.shape[2]
+    columns = np.reshape(stack, (-1, zdim))
+    z_min, z_max = _window_bounds(surface.ravel(), zabove, zbelow, zdim)
+    projection = _reduce_windows(columns, z_min, z_max, proj_method)
+    return projection.reshape(surface.shape).view(Image)
+
+
+def _filter_halo(size):
+    """Return the number of voxels the percentile filter reads either side."""
+    return int(np.max(size))
+
+
+def _project_filtered_tile(stack, surface_tile, y0, percentile, size,
+                           zabove, zbelow, proj_method):
+    """Return projection of the percentile filtered stack for a tile of rows.
+
+    The tile starts at row y0 of the stack and has as many rows as the
+    surface tile. Only the z-band covered by the projection windows, plus a
+    halo for the filter footprint, is filtered. The result is identical to
+    filtering the whole stack.
+    """
+    ydim, xdim, zdim = stack.shape
+    y1 = y0 + surface_tile.shape[0]
+    halo = _filter_halo(size)
+    z_min, z_max = _window_bounds(surface_tile.ravel(), zabove, zbelow, zdim)
+    z_lo = max(int(z_min.min()) - halo, 0)
+    z_hi = min(int(z_max.max()) + halo, zdim)
+    y_lo = max(y0 - halo, 0)
+    y_hi = min(y1 + halo, ydim)
+    band = nd.percentile_filter(np.asarray(stack[y_lo:y_hi, :, z_lo:z_hi]),
+                                percentile, size)
+    band = band[y0 - y_lo:y1 - y_lo]
+    columns = np.reshape(band, (-1, z_hi - z_lo))
+    tile = _reduce_windows(columns, z_min - z_lo, z_max - z_lo, proj_method)
+    return tile.reshape(surface_tile.shape)
+
+
+def _project_filtered(stack, surface, percentile, size, zabove, zbelow,
+                      proj_method, tile_rows=256):
+    """Return projection of the percentile filtered stack.
+
+    The stack is filtered and projected in tiles of rows.
+    """
+    ydim = stack.shape[0]
     projection = np.zeros(surface.shape, dtype=np.uint8)
-    xdim, ydim, zdim = stack.shape
-    for x in range(xdim):
-        for y in range(ydim):
-            z_index = surface[x, y]
-            z_min = z_index - zabove
-            z_min = max(0, z_min)
-            if z_min >= zdim:
-                z_min = zdim - 1
-            z_max = z_index + 1 + zbelow
-            z_max = min(z_max, zdim)
-            if z_max <= z_min:
-                z_max = z_min + 1
-            value = proj_method(stack[x, y, z_min:z_max])
-            projection[x, y] = value
+    for y0 in range(0, ydim, tile_rows):
+        y1 = min(y0 + tile_rows, ydim)
+        projection[y0:y1] = _project_filtered_tile(stack, surface[y0:y1], y0,
+                                                   percentile, size,
+                                                   zabove, zbelow,
+                                                   proj_method)
     return projection.view(Image)
 
 
+def _remove_noise(image, min_threshold):
+    image[image < min_threshold] = 0
+    return image
+
+
 @transformation
 def mean_project(stack, surface, zabove, zbelow):
     """Return mean intensity from stack based on surface."""
@@ -45,20 +123,23 @@ def percentile_filter(stack, p, size):
 
 @transformation
 def remove_noise(image, min_threshold):
-    image[image < min_threshold] = 0
-    return image
+    return _remove_noise(image, min_threshold)
 
 
 @transformation
 def project_wall(wall_stack, surface, **kwargs):
-    """Return wall signal projected from surface."""
-    wall_signal = percentile_filter(wall_stack,
-                                    kwargs["wall_percentile_filter_percentile"],
-                                    kwargs["wall_percentile_filter_size"])
-    return mean_project(wall_signal,
-                        surface,
-                        zabove=kwargs["wall_zabove"],
-                        zbelow=kwargs["wall_zbelow"])
+    """Return wall signal projected from surface.
+
+    The percentile filter is only applied to the z-band around the surface
+    that the mean projection reads.
+    """
+    return _project_filtered(wall_stack,
+                             surface,
+                             kwargs["wall_percentile_filter_percentile"],
+                             kwargs["wall_percentile_filter_size"],
+                             zabove=kwargs["wall_zabove"],
+                             zbelow=kwargs["wall_zbelow"],
+                             proj_method=np.mean)
 
 
 @transformation
@@ -90,3 +171,34 @@ def test_mean_project():
                           [[9]])
     assert np.array_equal(mean_project(stack, surface, 7, -6),
                           [[0]])
+
+
+def test_project_reducer():
+    stack = np.zeros((2, 2, 4), dtype=np.uint8)
+    stack[:, :, :] = [1, 2, 6, 9]
+    surface = np.array([[0, 1], [2, 3]], dtype=np.uint8)
+    assert np.array_equal(_project(stack, surface, 1, 1, np.median),
+                          [[1, 2], [6, 7]])
+    assert np.array_equal(max_project(stack, surface, 0, 1),
+                          [[2, 6], [9, 9]])
+
+
+def test_project_filtered():
+    random = np.random.RandomState(0)
+    for i in range(12):
+        ydim, xdim, zdim = random.randint(1, 16, 2).tolist() + [
+            random.randint(2, 12)]
+        stack = random.randint(0, 255, (ydim, xdim, zdim)).astype(np.uint8)
+        surface = random.randint(0, zdim, (ydim, xdim)).astype(np.uint8)
+        surface.flat[0] = 0
+        surface.flat[-1] = zdim - 1
+        percentile = random.choice([50, 95])
+        size = 1 + i % 3
+        zabove, zbelow = [(-3, 6), (2, 2), (0, 0)][i % 3]
+        filtered = nd.percentile_filter(stack, percentile, size)
+        expected = _project(filtered, surface, zabove, zbelow, np.mean)
+        for tile_rows in [1, 3, 7, 256]:
+            actual = _project_filtered(stack, surface, percentile, size,
+                                       zabove, zbelow, np.mean,
+                                       tile_rows=tile_rows)
+            assert np.array_equal(actual, expected)
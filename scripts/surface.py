@@ -2,18 +2,64 @@
 
 import numpy as np
 from jicbioimage.core.image import Image
-from jicbioimage.core.transform import transformation
+
+from profiling import transformation
+
+
+def _percentile_cutoff(stack, percentile):
+    """Return per-pixel percentile along z using a partial selection.
+
+    Uses the same linear interpolation as np.percentile, but only the two
+    order statistics that are needed are selected for each column.
+    """
+    zdim = stack.shape[2]
+    index = (percentile / 100.) * (zdim - 1)
+    below = int(np.floor(index))
+    above = min(below + 1, zdim - 1)
+    weight_above = index - below
+    weight_below = 1.0 - weight_above
+    selected = np.partition(stack, [below, above], axis=2)
+    cutoff = selected[:, :, below] * weight_below
+    cutoff += selected[:, :, above] * weight_above
+    return cutoff
+
+
+def surface_dtype(zdim):
+    """Return the smallest unsigned dtype that can hold zdim z-indices."""
+    return np.min_scalar_type(max(zdim - 1, 0))
+
+
+def _surface(stack, percentile):
+    """Return surface array; see :func:`surface_from_stack`."""
+    stack = np.asarray(stack)
+    ydim, xdim, zdim = stack.shape
+    surface = np.zeros((ydim, xdim), dtype=surface_dtype(zdim))
+    if zdim < 2:
+        return surface
+    cutoff = _percentile_cutoff(stack, percentile)
+    above = stack[:, :, 1:] > cutoff[:, :, np.newaxis]
+    found = np.any(above, axis=2)
+    first = np.argmax(above, axis=2) + 1
+    surface[found] = first[found]
+    return surface
 
 
 @transformation
 def surface_from_stack(stack, **kwargs):
-    """Return surface as 2D image where intensity represents z-depth."""
-    ydim, xdim, zdim = stack.shape
-    cutoff = np.percentile(stack, kwargs["surface_percentile"], axis=2)
-    surface = np.zeros((ydim, xdim), dtype=np.uint8)
-    for zi in range(0, zdim):
-        mask = stack[:, :, zi] > cutoff
-        not_done = surface == 0
-        mask = mask * not_done
-        surface[mask] = zi
-    return surface.view(Image)
+    """Return surface as 2D image where intensity represents z-depth.
+
+    The surface is the first z-slice, after the first one, where the intensity
+    is above the per-pixel percentile cutoff; 0 if there is no such slice.
+    The dtype is wide enough to hold the deepest z-index of the stack.
+    """
+    return _surface(stack, kwargs["surface_percentile"]).view(Image)
+
+
+def test_surface_from_stack():
+    stack = np.zeros((1, 3, 5), dtype=np.uint8)
+    stack[0, 0] = [9, 0, 0, 0, 0]
+    stack[0, 1] = [9, 0, 5, 1, 0]
+    stack[0, 2] = [0, 0, 0, 7, 7]
+    surface = surface_from_stack(stack, surface_percentile=50)
+    assert np.array_equal(surface, [[0, 2, 3]])
+    assert surface.dtype == np.uint8
@@ -0,0 +1,346 @@
+"""Sweep a grid of parameter values for one leaf.
+
+The grid file lists the values to try for each parameter; the parameters
+not in the grid are taken from the parameters file::
+
+    surface_percentile: [75, 95]
+    wall_zabove: [-4, -3]
+    wall_threshold_adaptive_block_size: [51, 101, 151]
+
+Every combination of the values is segmented, but each distinct surface,
+wall projection and segmentation is only computed once and shared by the
+combinations that only differ in parameters of later stages. Parameters
+that none of the stages depend on are rejected. The stages are
+computed in parallel. A ``sweep-summary.csv`` file with the number of cells,
+their area distribution and the run time of every combination is written to
+the output directory.
+"""
+
+import os
+import csv
+import json
+import logging
+import argparse
+import itertools
+import multiprocessing
+from time import time
+
+import numpy as np
+import yaml
+
+from jicbioimage.core.io import AutoWrite
+
+from utils import (
+    get_microscopy_collection,
+    lazy_zstack,
+    run_in_processes,
+    killed_status,
+)
+from parameters import Parameters
+from surface import surface_from_stack
+from projection import project_wall
+from pipeline import (
+    stack_tile_rows,
+    tiled_surface_from_stack,
+    tiled_project_wall,
+)
+from segment import segment_cells
+from analysis import load_mask
+
+__version__ = "0.1.0"
+
+#: Parameters that each stage depends on, including those of earlier stages.
+SURFACE_PARAMS = ["wall_channel", "surface_percentile"]
+WALL_PARAMS = SURFACE_PARAMS + ["wall_percentile_filter_percentile",
+                                "wall_percentile_filter_size",
+                                "wall_zabove",
+                                "wall_zbelow"]
+CELLS_PARAMS = WALL_PARAMS + ["wall_threshold_adaptive_block_size",
+                              "wall_remove_small_objects_in_cell_min_size",
+                              "wall_erode_step",
+                              "wall_remove_small_objects_in_wall_min_size",
+                              "wall_threshold_adaptive_method",
+                              "segment_crop_margin"]
+
+SUMMARY_KEYS = ["cell_count", "area_mean", "area_median", "area_p10",
+                "area_p90", "seconds"]
+
+#: Inputs and results shared with the worker processes when they are forked.
+_shared = dict()
+
+
+def read_grid(fpath):
+    """Return dictionary of parameter names and lists of values."""
+    with open(fpath) as fh:
+        grid = yaml.load(fh.read())
+    if not isinstance(grid, dict):
+        raise(RuntimeError("Grid file must map parameters to values"))
+    check_grid(grid)
+    for name, values in grid.items():
+        if not isinstance(values, list):
+            grid[name] = [values]
+    return grid
+
+
+def check_grid(grid):
+    """Raise error if the grid has parameters that no stage depends on.
+
+    The results of such parameters would be shared by all their values.
+    """
+    unknown = sorted(set(grid.keys()) - set(CELLS_PARAMS))
+    if unknown:
+        raise(RuntimeError("Parameters not used by the sweep: {}".format(
+            ", ".join(unknown))))
+
+
+def combinations(params, grid):
+    """Return list of parameters of every combination of the grid values."""
+    names = sorted(grid.keys())
+    combos = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        combo = Parameters(params)
+        combo.update(zip(names, values))
+        combos.append(combo)
+    return combos
+
+
+def stage_key(params, names):
+    """Return key identifying the result of a stage."""
+    return json.dumps([[name, params.get(name)] for name in names])
+
+
+def area_summary(cells):
+    """Return dictionary with the number of cells and their areas."""
+    areas = np.bincount(np.asarray(cells).ravel())[1:]
+    areas = areas[areas > 0]
+    if len(areas) == 0:
+        return dict(cell_count=0, area_mean=0, area_median=0, area_p10=0,
+                    area_p90=0)
+    return dict(cell_count=len(areas),
+                area_mean=round(float(np.mean(areas)), 1),
+                area_median=float(np.median(areas)),
+                area_p10=float(np.percentile(areas, 10)),
+                area_p90=float(np.percentile(areas, 90)))
+
+
+def max_processes(processes, memory_budget_mb):
+    """Return number of processes whose memory budgets fit in memory."""
+    if not memory_budget_mb:
+        return processes
+    total_mb = (os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+                / (1024. * 1024.))
+    return max(1, min(processes, int(total_mb // memory_budget_mb)))
+
+
+def _surface_job(params):
+    start = time()
+    stack = _shared["stacks"][params["wall_channel"]]
+    if params.get("memory_budget_mb"):
+        surface = tiled_surface_from_stack(stack,
+                                           stack_tile_rows(stack, **params),
+                                           **params)
+    else:
+        surface = surface_from_stack(stack, **params)
+    surface = np.asarray(surface)
+    return stage_key(params, SURFACE_PARAMS), surface, time() - start
+
+
+def _wall_job(params):
+    start = time()
+    stack = _shared["stacks"][params["wall_channel"]]
+    surface, _ = _shared["surfaces"][stage_key(params, SURFACE_PARAMS)]
+    if params.get("memory_budget_mb"):
+        wall_projection = tiled_project_wall(stack, surface,
+                                             stack_tile_rows(stack, **params),
+                                             **params)
+    else:
+        wall_projection = project_wall(stack, surface, **params)
+    wall_projection = np.asarray(wall_projection)
+    return stage_key(params, WALL_PARAMS), wall_projection, time() - start
+
+
+def _cells_job(params):
+    start = time()
+    surface, _ = _shared["surfaces"][stage_key(params, SURFACE_PARAMS)]
+    wall_projection, _ = _shared["walls"][stage_key(params, WALL_PARAMS)]
+    cells = segment_cells(wall_projection, surface, _shared["mask"],
+                          **params)
+    summary = area_summary(cells)
+    return stage_key(params, CELLS_PARAMS), summary, time() - start
+
+
+def _run_stage(name, job, combos, keys, processes):
+    """Return dictionary of (result, seconds) of each distinct stage key.
+
+    The worker processes are forked after the results of the earlier stages
+    are in place, so that they can read them without copying. An error is
+    raised if a worker process is killed.
+    """
+    distinct = dict()
+    for params in combos:
+        distinct.setdefault(stage_key(params, keys), params)
+    logging.info("Computing {} distinct {}".format(len(distinct), name))
+
+    results = dict()
+    for params, result, exitcode in run_in_processes(job, distinct.values(),
+                                                     processes):
+        if result is None:
+            raise(RuntimeError("Worker computing {} for {} {}".format(
+                name, stage_key(params, keys), killed_status(exitcode))))
+        key, result, seconds = result
+        results[key] = (result, seconds)
+    return results
+
+
+def sweep(input_file, mask, combos, processes=None):
+    """Return list of summaries of the combinations of parameters.
+
+    The run time of a combination is the sum of the times of the stages it
+    depends on, i.e. roughly that of segmenting it on its own.
+
+    If ``memory_budget_mb`` is set the stacks are memory-mapped and
+    processed in tiles, and the number of processes is capped so that
+    their budgets fit in memory.
+    """
+    AutoWrite.on = False
+    microscopy_collection = get_microscopy_collection(input_file)
+    channels = set([params["wall_channel"] for params in combos])
+    memory_budget_mb = combos[0].get("memory_budget_mb")
+    if memory_budget_mb:
+        _shared["stacks"] = dict(
+            (c, lazy_zstack(microscopy_collection, c=c)) for c in channels)
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        processes = max_processes(processes, memory_budget_mb)
+        logging.info("Using {} processes".format(processes))
+    else:
+        _shared["stacks"] = dict(
+            (c, microscopy_collection.zstack_array(c=c)) for c in channels)
+    _shared["mask"] = mask
+    try:
+        surfaces = _run_stage("surfaces", _surface_job, combos,
+                              SURFACE_PARAMS, processes)
+        _shared["surfaces"] = surfaces
+        walls = _run_stage("wall projections", _wall_job, combos,
+                           WALL_PARAMS, processes)
+        _shared["walls"] = walls
+        cells = _run_stage("segmentations", _cells_job, combos,
+                           CELLS_PARAMS, processes)
+    finally:
+        _shared.clear()
+
+    summaries = []
+    for params in combos:
+        summary, seconds = cells[stage_key(params, CELLS_PARAMS)]
+        seconds += surfaces[stage_key(params, SURFACE_PARAMS)][1]
+        seconds += walls[stage_key(params, WALL_PARAMS)][1]
+        summaries.append(dict(summary, seconds=round(seconds, 1)))
+    return summaries
+
+
+def write_summary(combos, summaries, grid, fpath):
+    """Write the swept parameters and summary of every combination."""
+    names = sorted(grid.keys())
+    with open(fpath, "w") as fh:
+        writer = csv.writer(fh)
+        writer.writerow(names + SUMMARY_KEYS)
+        for params, summary in zip(combos, summaries):
+            writer.writerow([params.get(name) for name in names]
+                            + [summary[key] for key in SUMMARY_KEYS])
+
+
+def test_combinations():
+    params = Parameters(surface_percentile=75, wall_zabove=-3, wall_zbelow=6)
+    grid = dict(wall_zabove=[-4, -3], wall_zbelow=[5, 6, 7])
+    combos = combinations(params, grid)
+    assert len(combos) == 6
+    assert combos[0] == dict(surface_percentile=75, wall_zabove=-4,
+                             wall_zbelow=5)
+    assert params["wall_zabove"] == -3
+    keys = set([stage_key(c, SURFACE_PARAMS) for c in combos])
+    assert len(keys) == 1
+    keys = set([stage_key(c, WALL_PARAMS) for c in combos])
+    assert len(keys) == 6
+
+
+def test_check_grid():
+    check_grid(dict(wall_zabove=[-4, -3], surface_percentile=[75]))
+    try:
+        check_grid(dict(wall_zabove=[-4, -3], wall_zabvoe=[5, 6]))
+    except RuntimeError as e:
+        assert "wall_zabvoe" in str(e)
+        assert "wall_zabove" not in str(e)
+    else:
+        assert False, "Unknown grid parameter not rejected"
+
+
+def test_max_processes():
+    assert max_processes(8, None) == 8
+    assert max_processes(8, 1) == 8
+    assert max_processes(8, 1024 * 1024 * 1024) == 1
+
+
+def test_area_summary():
+    cells = np.array([[1, 1, 0, 3],
+                      [1, 1, 0, 3]])
+    summary = area_summary(cells)
+    assert summary["cell_count"] == 2
+    assert summary["area_mean"] == 3.0
+    assert summary["area_median"] == 3.0
+
+
+def main():
+    # Parse the command line arguments.
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input_file", help="Input file")
+    parser.add_argument("mask_file", help="Mask file")
+    parser.add_argument("parameters_file", help="Parameters file")
+    parser.add_argument("grid_file", help="Grid of parameter values")
+    parser.add_argument("output_dir", help="Output directory")
+    parser.add_argument("-p", "--processes", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Number of worker processes")
+    args = parser.parse_args()
+
+    # Check that the input files exist.
+    for fpath in [args.input_file, args.mask_file, args.parameters_file,
+                  args.grid_file]:
+        if not os.path.isfile(fpath):
+            parser.error("{} not a file".format(fpath))
+
+    # Read in the parameters and the grid.
+    params = Parameters.from_file(args.parameters_file)
+    try:
+        grid = read_grid(args.grid_file)
+    except RuntimeError as e:
+        parser.error(str(e))
+    combos = combinations(params, grid)
+
+    # Create the output directory if it does not exist.
+    if not os.path.isdir(args.output_dir):
+        os.mkdir(args.output_dir)
+
+    # Setup a logger for the script.
+    log_fpath = os.path.join(args.output_dir, "audit.log")
+    logging.basicConfig(filename=log_fpath, level=logging.INFO)
+
+    # Log some basic information about the script that is running.
+    logging.info("Script name: {}".format(__file__))
+    logging.info("Script version: {}".format(__version__))
+    logging.info("Parameters: {}".format(params))
+    logging.info("Grid: {}".format(grid))
+
+    # Run the sweep.
+    start = time()
+    mask = load_mask(args.mask_file)
+    summaries = sweep(args.input_file, mask, combos, args.processes)
+    write_summary(combos, summaries, grid,
+                  os.path.join(args.output_dir, "sweep-summary.csv"))
+    logging.info("Swept {} combinations in {:.1f} s".format(len(combos),
+                                                            time() - start))
+
+
+if __name__ == "__main__":
+    main()
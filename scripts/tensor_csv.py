@@ -1,67 +1,156 @@
-"""Generate tensor csv file."""
+"""Generate tensor csv file.
+
+The cells are written in order of their cell id. Output files ending in
+``.gz`` are gzip compressed. Given several input directories a combined csv
+file with a leaf column is written.
+"""
 
 import argparse
 import os
-import json
+import gzip
 
-from geometry_mapper import original_image_point
+from geometry_mapper import original_image_points
+from cellstore import tagged_celldata
 
-__version__ = "0.1.0"
+__version__ = "0.2.0"
 
-def write_csv(input_dir, output_file, random):
-    """Write csv file."""
-    csv_lines = ["id,mx,my,cx,cy", ]
-    json_fpaths = [os.path.join(input_dir, f)
-                   for f in os.listdir(input_dir)
-                   if f.endswith(".json")]
+CSV_HEADER = "id,mx,my,cx,cy"
 
+
+def marker_points(tagged, random):
+    """Return list of (y, x) marker points of tagged cells in the leaf."""
     y_key = "normalised_marker_y_coord"
     x_key = "normalised_marker_x_coord"
-    identifier = 1
-    for fpath in json_fpaths:
-        with open(fpath) as fh:
-            celldata = json.load(fh)
-
-        if y_key not in celldata:
-            continue
-        if x_key not in celldata:
-            continue
-        print(fpath)
-        frac_pt = celldata[y_key], celldata[x_key]
-        rel_pt = tuple([i - 0.5 for i in frac_pt])
-
-        rotation = celldata["rotation"]
-        if random:
-            rotation = 0
-        marker_pt = original_image_point(rel_point=rel_pt,
-                                         rotation=rotation,
-                                         ydim=celldata["ydim"],
-                                         xdim=celldata["xdim"],
-                                         dy_offset=celldata["dy_offset"],
-                                         dx_offset=celldata["dx_offset"])
+    rel_points = [(c[y_key] - 0.5, c[x_key] - 0.5) for c in tagged]
+    if random:
+        rotations = 0
+    else:
+        rotations = [c["rotation"] for c in tagged]
+    points = original_image_points(rel_points,
+                                   rotations,
+                                   [c["ydim"] for c in tagged],
+                                   [c["xdim"] for c in tagged],
+                                   [c["dy_offset"] for c in tagged],
+                                   [c["dx_offset"] for c in tagged])
+    return [tuple(pt) for pt in points.tolist()]
+
+
+def tensor_rows(tagged, points, first_identifier=1):
+    """Yield csv rows of tagged cells and their marker points."""
+    for identifier, (celldata, marker_pt) in enumerate(zip(tagged, points),
+                                                       first_identifier):
         my, mx = marker_pt
         cy, cx = celldata["centroid"]
-        csv_lines.append("{},{},{},{},{}".format(identifier, mx, my, cx, cy))
-        identifier += 1
+        yield "{},{},{},{},{}".format(identifier, mx, my, cx, cy)
+
+
+def open_csv(fpath, mode="wb"):
+    """Return binary file handle, gzip compressed if fpath ends in .gz."""
+    if fpath.endswith(".gz"):
+        # A fixed modification time makes the compressed output reproducible.
+        return gzip.GzipFile(fpath, mode, mtime=0)
+    return open(fpath, mode)
+
+
+def _write_rows(fh, rows):
+    for row in rows:
+        fh.write(("\n" + row).encode("utf-8"))
+
+
+def write_tensors(output_file, tagged, points):
+    """Write csv file of tagged cells and their marker points."""
+    with open_csv(output_file) as fh:
+        fh.write(CSV_HEADER.encode("utf-8"))
+        _write_rows(fh, tensor_rows(tagged, points))
+
+
+def append_tensors(output_file, tagged, points, first_identifier):
+    """Append tagged cells and their marker points to a csv file."""
+    with open_csv(output_file, "ab") as fh:
+        _write_rows(fh, tensor_rows(tagged, points, first_identifier))
+
+
+def leaf_name(input_dir):
+    """Return leaf name of an annotated cells directory."""
+    directory = os.path.normpath(os.path.abspath(input_dir))
+    if os.path.basename(directory) == "annotated-cells":
+        directory = os.path.dirname(directory)
+    return os.path.basename(directory)
+
+
+def write_csv(input_dir, output_file, random):
+    """Write csv file."""
+    tagged = tagged_celldata(input_dir)
+    write_tensors(output_file, tagged, marker_points(tagged, random))
+
+
+def write_combined_csv(input_dirs, output_file, random):
+    """Write csv file of several leaves, with a leaf column.
+
+    The leaves are written in order of their name and the cell identifiers
+    are numbered from one for each leaf.
+    """
+    leaves = sorted([(leaf_name(d), d) for d in input_dirs])
+    with open_csv(output_file) as fh:
+        fh.write(("leaf," + CSV_HEADER).encode("utf-8"))
+        for name, input_dir in leaves:
+            tagged = tagged_celldata(input_dir)
+            rows = tensor_rows(tagged, marker_points(tagged, random))
+            _write_rows(fh, ("{},{}".format(name, row) for row in rows))
+
 
-    with open(output_file, "w") as fh:
-        fh.write("\n".join(csv_lines))
+def test_write_combined_csv():
+    import json
+    import shutil
+    import tempfile
+    celldata = dict(cell_id=2, centroid=[10.5, 20.0], area=4, dy_offset=0,
+                    dx_offset=10, ydim=20, xdim=40, rotation=90,
+                    normalised_marker_y_coord=0.,
+                    normalised_marker_x_coord=0.5)
+    directory = tempfile.mkdtemp()
+    try:
+        for leaf in ["leaf2", "leaf1"]:
+            input_dir = os.path.join(directory, leaf, "annotated-cells")
+            os.makedirs(input_dir)
+            for cell_id in [12, 2]:
+                fname = "cell-{:05d}.json".format(cell_id)
+                with open(os.path.join(input_dir, fname), "w") as fh:
+                    json.dump(dict(celldata, cell_id=cell_id), fh)
+        input_dirs = [os.path.join(directory, leaf, "annotated-cells")
+                      for leaf in ["leaf2", "leaf1"]]
+        output_file = os.path.join(directory, "tensors.csv.gz")
+        write_combined_csv(input_dirs, output_file, random=False)
+        with gzip.open(output_file) as fh:
+            lines = fh.read().decode("utf-8").split("\n")
+        assert lines[0] == "leaf,id,mx,my,cx,cy"
+        assert lines[1] == "leaf1,1,50,10,20.0,10.5"
+        assert lines[4] == "leaf2,2,50,10,20.0,10.5"
+        assert len(lines) == 5
+    finally:
+        shutil.rmtree(directory)
 
 
 def main():
     # Parse the command line arguments.
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("input_dir", help="Input directory (with json files)")
-    parser.add_argument("output_file", help="Output file")
+    parser.add_argument("input_dirs", nargs="+", metavar="input_dir",
+                        help="Input directory (with json files)")
+    parser.add_argument("output_file", help="Output file (.gz to compress)")
     parser.add_argument("--random", action="store_true", help="Use random rotation")
+    parser.add_argument("--combined", action="store_true",
+                        help="Add leaf column, implied by several input dirs")
     args = parser.parse_args()
 
-    # Check that the input directory and files exists.
-    if not os.path.isdir(args.input_dir):
-        parser.error("{} not a directory".format(args.input_dir))
+    # Check that the input directories exist.
+    for input_dir in args.input_dirs:
+        if not os.path.isdir(input_dir):
+            parser.error("{} not a directory".format(input_dir))
 
     # Run the analysis.
-    write_csv(args.input_dir, args.output_file, args.random)
+    if args.combined or len(args.input_dirs) > 1:
+        write_combined_csv(args.input_dirs, args.output_file, args.random)
+    else:
+        write_csv(args.input_dirs[0], args.output_file, args.random)
 
 if __name__ == "__main__":
     main()
@@ -1,9 +1,17 @@
 """Utility functions."""
 
+import os
 import os.path
+import json
+import shutil
 import logging
+import tempfile
+import multiprocessing
+from time import sleep
 
-from jicbioimage.core.image import MicroscopyCollection
+import numpy as np
+
+from jicbioimage.core.image import Image, MicroscopyCollection
 from jicbioimage.core.io import (
     FileBackend,
     DataManager,
@@ -11,43 +19,446 @@ from jicbioimage.core.io import (
 )
 
 HERE = os.path.dirname(os.path.realpath(__file__))
+INDEX_FNAME = "index.json"
+STAGING_DNAME = ".staging"
+VOLUME_FNAME_FORMAT = "volume-s{}-c{}-t{}.npy"
 
 
-def get_data_manager():
-    """Return a data manager."""
+def get_data_dir():
+    """Return the data directory."""
     data_dir = os.path.abspath(os.path.join(HERE, "..", "output"))
     if not os.path.isdir(data_dir):
         raise(OSError("Data directory does not exist: {}".format(data_dir)))
+    return data_dir
+
+
+def get_data_manager():
+    """Return a data manager."""
+    data_dir = get_data_dir()
     backend_dir = os.path.join(data_dir, 'unpacked')
     file_backend = FileBackend(backend_dir)
     return DataManager(file_backend), backend_dir
 
 
-def get_microscopy_collection_from_tiff(input_file):
-    """Return microscopy collection from tiff file."""
-    data_manager, backend_dir = get_data_manager()
-    data_manager.load(input_file)
+def manifest_is_complete(manifest_path):
+    """Return True if the manifest exists and all the files it lists exist."""
+    if not os.path.isfile(manifest_path):
+        return False
+    try:
+        with open(manifest_path) as fh:
+            entries = json.load(fh)
+    except ValueError:
+        return False
+    directory = os.path.dirname(manifest_path)
+    for entry in entries:
+        fname = os.path.basename(entry["filename"])
+        if not os.path.isfile(os.path.join(directory, fname)):
+            return False
+    return True
 
-    md5_hex = _md5_hexdigest_from_file(input_file)
+
+class PlaneCache(object):
+    """Settings for the cache of z-stacks as memory-mapped volumes."""
+
+    #: Whether to write a volume for z-stacks that do not have one yet.
+    on = False
+
+
+class UnpackedIndex(object):
+    """Settings for the index of unpacked files."""
+
+    #: Whether to hash input files rather than trusting the index.
+    verify = False
+
+
+def file_signature(fpath):
+    """Return signature used to tell whether a file has changed."""
+    st = os.stat(fpath)
+    return [st.st_size, st.st_mtime, st.st_ino]
+
+
+def read_index(backend_dir):
+    """Return index mapping input file paths to backend md5 directories."""
+    index_path = os.path.join(backend_dir, INDEX_FNAME)
+    if not os.path.isfile(index_path):
+        return {}
+    try:
+        with open(index_path) as fh:
+            return json.load(fh)
+    except ValueError:
+        logging.warning("Ignoring corrupt index: {}".format(index_path))
+        return {}
+
+
+def write_index(backend_dir, index):
+    """Write index atomically."""
+    index_path = os.path.join(backend_dir, INDEX_FNAME)
+    fd, tmp_path = tempfile.mkstemp(dir=backend_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as fh:
+        json.dump(index, fh, sort_keys=True)
+    os.rename(tmp_path, index_path)
+
+
+def index_entry(fpath, md5_hex):
+    """Return index key and entry for an unpacked file."""
+    return os.path.realpath(fpath), dict(signature=file_signature(fpath),
+                                         md5_hexdigest=md5_hex)
+
+
+def lookup_index(index, fpath):
+    """Return md5 hex digest of fpath if it is in the index and unchanged."""
+    entry = index.get(os.path.realpath(fpath))
+    if entry is None:
+        return None
+    if entry["signature"] != file_signature(fpath):
+        return None
+    return entry["md5_hexdigest"]
+
+
+def is_unpacked(backend_dir, md5_hex):
+    """Return True if the backend has a complete entry for md5_hex."""
     manifest_path = os.path.join(backend_dir, md5_hex, "manifest.json")
+    return manifest_is_complete(manifest_path)
+
+
+def clean_backend(backend_dir):
+    """Remove incomplete entries and staging left behind by a crash.
+
+    Only call this when no other process is unpacking into the backend.
+    """
+    staging_dir = os.path.join(backend_dir, STAGING_DNAME)
+    if os.path.isdir(staging_dir):
+        shutil.rmtree(staging_dir)
+    for dname in os.listdir(backend_dir):
+        dpath = os.path.join(backend_dir, dname)
+        if len(dname) != 32 or not os.path.isdir(dpath):
+            continue
+        if not is_unpacked(backend_dir, dname):
+            logging.warning("Removing incomplete entry: {}".format(dpath))
+            shutil.rmtree(dpath)
+            continue
+        for fname in os.listdir(dpath):
+            if fname.endswith(".tmp"):
+                os.remove(os.path.join(dpath, fname))
+
+
+def unpack(input_file):
+    """Unpack input file into the backend; return its md5 hex digest."""
+    data_manager, backend_dir = get_data_manager()
+    md5_hex = _md5_hexdigest_from_file(input_file)
+    if not is_unpacked(backend_dir, md5_hex):
+        data_manager.convert(input_file)
+    return md5_hex
+
+
+def unpacked_md5_hexdigest(input_file):
+    """Return md5 hex digest of an unpacked input file.
+
+    The index of unpacked files is used to avoid hashing the input file
+    when it has not changed, unless ``UnpackedIndex.verify`` is set. Files
+    that are not unpacked yet are unpacked and added to the index.
+    """
+    _, backend_dir = get_data_manager()
+    md5_hex = None
+    if not UnpackedIndex.verify:
+        md5_hex = lookup_index(read_index(backend_dir), input_file)
+    if md5_hex is not None and is_unpacked(backend_dir, md5_hex):
+        logging.debug("found {} in index".format(input_file))
+        return md5_hex
+
+    logging.debug("hashing and unpacking {}".format(input_file))
+    md5_hex = unpack(input_file)
+    index = read_index(backend_dir)
+    key, entry = index_entry(input_file, md5_hex)
+    index[key] = entry
+    write_index(backend_dir, index)
+    return md5_hex
+
+
+class MappedMicroscopyCollection(MicroscopyCollection):
+    """Microscopy collection that memory-maps its z-stacks where possible.
+
+    A z-stack can be stored as one contiguous ``.npy`` volume next to the
+    unpacked planes. If the volume exists the z-stack is memory-mapped from
+    it rather than decoded plane by plane. If it does not exist it is
+    written the first time the z-stack is read, when ``PlaneCache.on`` is
+    set. The volumes are read-only.
+    """
 
-    microscopy_collection = MicroscopyCollection()
+    def __init__(self, directory):
+        super(MappedMicroscopyCollection, self).__init__()
+        self.directory = directory
+
+    def volume_fpath(self, s=0, c=0, t=0):
+        """Return path of the volume of a z-stack."""
+        return os.path.join(self.directory,
+                            VOLUME_FNAME_FORMAT.format(s, c, t))
+
+    def mapped_zstack_array(self, s=0, c=0, t=0):
+        """Return memory-mapped z-stack, or None if there is no volume."""
+        fpath = self.volume_fpath(s=s, c=c, t=t)
+        if not os.path.isfile(fpath):
+            return None
+        try:
+            volume = np.load(fpath, mmap_mode="r")
+        except (IOError, ValueError):
+            logging.warning("Ignoring unreadable volume: {}".format(fpath))
+            return None
+        zdim = len(list(self.zstack_proxy_iterator(s=s, c=c, t=t)))
+        if volume.ndim != 3 or volume.shape[2] != zdim:
+            logging.warning("Ignoring mismatched volume: {}".format(fpath))
+            return None
+        return volume
+
+    def write_volume(self, s=0, c=0, t=0):
+        """Write the z-stack as a volume atomically; return its path."""
+        fpath = self.volume_fpath(s=s, c=c, t=t)
+        zstack = super(MappedMicroscopyCollection, self).zstack_array(s=s,
+                                                                      c=c,
+                                                                      t=t)
+        fd, tmp_fpath = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fh:
+            np.save(fh, np.ascontiguousarray(zstack))
+        os.rename(tmp_fpath, fpath)
+        return fpath
+
+    def zstack_array(self, s=0, c=0, t=0):
+        """Return z-stack, memory-mapped from its volume where possible."""
+        volume = self.mapped_zstack_array(s=s, c=c, t=t)
+        if volume is None and PlaneCache.on:
+            logging.info("Writing volume of series {} channel {} "
+                         "time point {}".format(s, c, t))
+            self.write_volume(s=s, c=c, t=t)
+            volume = self.mapped_zstack_array(s=s, c=c, t=t)
+        if volume is not None:
+            return volume
+        return super(MappedMicroscopyCollection, self).zstack_array(s=s,
+                                                                    c=c,
+                                                                    t=t)
+
+
+def get_microscopy_collection(input_file):
+    """Return microscopy collection from tiff or microscopy file."""
+    _, backend_dir = get_data_manager()
+    md5_hex = unpacked_md5_hexdigest(input_file)
+    directory = os.path.join(backend_dir, md5_hex)
+    manifest_path = os.path.join(directory, "manifest.json")
+
+    microscopy_collection = MappedMicroscopyCollection(directory)
     microscopy_collection.parse_manifest(manifest_path)
     return microscopy_collection
 
 
-def get_microscopy_collection_from_org(input_file):
-    """Return microscopy collection from microscopy file."""
-    data_manager, _ = get_data_manager()
-    return data_manager.load(input_file)
+class LazyZStack(object):
+    """Z-stack whose z-planes are read from the unpacked images on demand.
 
+    Only the first plane is read when the stack is created, to find the
+    shape and dtype of the stack. :meth:`to_volume` decodes the planes one
+    at a time into a temporary memory-mapped volume.
+    """
 
-def get_microscopy_collection(input_file):
-    name, ext = os.path.splitext(input_file)
-    ext = ext.lower()
-    if ext == '.tif' or ext == '.tiff':
-        logging.debug("reading in a tif file")
-        return get_microscopy_collection_from_tiff(input_file)
-    else:
-        logging.debug("reading in a microscopy file")
-        return get_microscopy_collection_from_org(input_file)
+    #: Directory of the temporary volumes written by :meth:`to_volume`;
+    #: the system temporary directory by default. The stacks of a
+    #: microscopy collection use the directory of its unpacked images.
+    volume_dir = None
+
+    def __init__(self, fpaths, volume_dir=None):
+        self._fpaths = list(fpaths)
+        if volume_dir is not None:
+            self.volume_dir = volume_dir
+        self.num_reads = 0
+        self._first_plane = None
+        self._first_plane = self._plane(0)
+        self.shape = self._first_plane.shape + (len(self._fpaths),)
+        self.dtype = self._first_plane.dtype
+        self.ndim = 3
+
+    @classmethod
+    def from_collection(cls, microscopy_collection, s=0, c=0, t=0):
+        """Return lazy z-stack of a series, channel and time point."""
+        return cls([proxy_image.fpath for proxy_image in
+                    microscopy_collection.zstack_proxy_iterator(s=s, c=c,
+                                                                t=t)],
+                   volume_dir=getattr(microscopy_collection, "directory",
+                                      None))
+
+    def _read_plane(self, z):
+        return np.asarray(Image.from_file(self._fpaths[z]))
+
+    def _plane(self, z):
+        """Return decoded plane."""
+        if z == 0 and self._first_plane is not None:
+            return self._first_plane
+        self.num_reads += 1
+        return self._read_plane(z)
+
+    def to_volume(self):
+        """Return the z-stack decoded into a temporary memory-mapped volume.
+
+        Every plane is decoded once, in z order, and written to an unnamed
+        temporary file in ``volume_dir`` that is removed when the volume is
+        no longer used. The volume is stored plane by plane and returned as
+        a view with the z-axis last.
+        """
+        ydim, xdim, zdim = self.shape
+        with tempfile.TemporaryFile(dir=self.volume_dir) as fh:
+            volume = np.memmap(fh, dtype=self.dtype, mode="w+",
+                               shape=(zdim, ydim, xdim))
+        for z in range(zdim):
+            volume[z] = self._plane(z)
+        self._first_plane = None
+        return volume.transpose(1, 2, 0)
+
+
+def lazy_zstack(microscopy_collection, s=0, c=0, t=0):
+    """Return z-stack as a memory-mapped volume.
+
+    This is the volume of the z-stack if it has one, or is given one because
+    ``PlaneCache.on`` is set, and a temporary volume next to the unpacked
+    images, see :meth:`LazyZStack.to_volume`, otherwise.
+    """
+    if isinstance(microscopy_collection, MappedMicroscopyCollection):
+        volume = microscopy_collection.mapped_zstack_array(s=s, c=c, t=t)
+        if volume is None and PlaneCache.on:
+            volume = microscopy_collection.zstack_array(s=s, c=c, t=t)
+        if volume is not None:
+            return volume
+    stack = LazyZStack.from_collection(microscopy_collection, s=s, c=c, t=t)
+    return stack.to_volume()
+
+
+def _run_job(conn, func, job):
+    conn.send(func(job))
+    conn.close()
+
+
+def run_in_processes(func, jobs, processes=None, poll_seconds=0.1):
+    """Yield (job, result, exitcode) of func called on every job.
+
+    Every job runs in a fresh process, at most ``processes`` at a time, and
+    the jobs are yielded as they finish. If a process dies without returning
+    its result, e.g. because it was killed by the kernel, the result is None
+    and the exit code is that of the process, minus the signal number if it
+    was killed by a signal; the other jobs carry on.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pending = list(jobs)[::-1]
+    running = []
+    try:
+        while pending or running:
+            while pending and len(running) < max(processes, 1):
+                job = pending.pop()
+                parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(
+                    target=_run_job, args=(child_conn, func, job))
+                process.start()
+                child_conn.close()
+                running.append((process, parent_conn, job))
+
+            finished = []
+            for process, conn, job in running:
+                alive = process.is_alive()
+                result = None
+                try:
+                    if conn.poll():
+                        result = conn.recv()
+                    elif alive:
+                        continue
+                except EOFError:
+                    pass
+                process.join()
+                conn.close()
+                finished.append((process, conn, job))
+                yield job, result, process.exitcode
+            if finished:
+                running = [r for r in running if r not in finished]
+            else:
+                sleep(poll_seconds)
+    finally:
+        for process, conn, _ in running:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+            conn.close()
+
+
+def killed_status(exitcode):
+    """Return status of a process that died without returning a result."""
+    if exitcode is not None and exitcode < 0:
+        return "killed (signal {})".format(-exitcode)
+    return "failed (exit code {})".format(exitcode)
+
+
+def test_mapped_microscopy_collection():
+
+    class ArrayProxy(object):
+        def __init__(self, image, c):
+            self.image = image
+            self.c = c
+
+        def in_zstack(self, s, c, t):
+            return c == self.c
+
+    random = np.random.RandomState(0)
+    stack = random.randint(0, 255, (6, 5, 4)).astype(np.uint8)
+    directory = tempfile.mkdtemp()
+    try:
+        collection = MappedMicroscopyCollection(directory)
+        for c in range(2):
+            collection.extend([ArrayProxy(stack[:, :, z] + c, c)
+                               for z in range(4)])
+        zstack = collection.zstack_array(c=1)
+        assert not isinstance(zstack, np.memmap)
+        assert np.array_equal(zstack, stack + 1)
+        assert not os.path.isfile(collection.volume_fpath(c=1))
+
+        PlaneCache.on = True
+        zstack = collection.zstack_array(c=1)
+        assert isinstance(zstack, np.memmap)
+        assert np.array_equal(zstack, stack + 1)
+        PlaneCache.on = False
+        assert isinstance(collection.zstack_array(c=1), np.memmap)
+        assert isinstance(lazy_zstack(collection, c=1), np.memmap)
+        assert np.array_equal(collection.zstack_array(c=0), stack)
+    finally:
+        PlaneCache.on = False
+        shutil.rmtree(directory)
+
+
+def test_lazy_zstack():
+
+    class TestZStack(LazyZStack):
+        def _read_plane(self, z):
+            return self._fpaths[z]
+
+    random = np.random.RandomState(0)
+    stack = random.randint(0, 255, (6, 5, 4)).astype(np.uint8)
+    directory = tempfile.mkdtemp()
+    try:
+        lazy = TestZStack([stack[:, :, z] for z in range(4)],
+                          volume_dir=directory)
+        assert lazy.shape == (6, 5, 4)
+        assert lazy.num_reads == 1
+        volume = lazy.to_volume()
+        assert lazy.num_reads == 4
+        assert np.array_equal(volume, stack)
+        assert np.array_equal(volume[2:4, :, 1:3], stack[2:4, :, 1:3])
+        assert os.listdir(directory) == []
+    finally:
+        shutil.rmtree(directory)
+
+
+def _square_or_die(x):
+    if x == 3:
+        os.kill(os.getpid(), 9)
+    return x * x
+
+
+def test_run_in_processes():
+    results = sorted(run_in_processes(_square_or_die, range(5), processes=2,
+                                      poll_seconds=0.01))
+    assert results[:3] == [(0, 0, 0), (1, 1, 0), (2, 4, 0)]
+    assert results[3] == (3, None, -9)
+    assert results[4] == (4, 16, 0)
+    assert killed_status(-9) == "killed (signal 9)"
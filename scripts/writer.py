@@ -0,0 +1,118 @@
+"""Module for writing output files in background threads.
+
+Files are written to a temporary file that is renamed into place once
+complete, so that readers never see partially written files. The number of
+pending writes is bounded; submitting a write blocks when the queue is full.
+"""
+
+import os
+import json
+import logging
+import threading
+from time import time
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+import numpy as np
+import scipy.misc
+
+
+def _write_png(fpath, array):
+    scipy.misc.imsave(fpath, array, format="png")
+
+
+def _write_npz(fpath, array):
+    with open(fpath, "wb") as fh:
+        np.savez_compressed(fh, image=array)
+
+
+def _write_text(fpath, text):
+    with open(fpath, "w") as fh:
+        fh.write(text)
+
+
+class WriterPool(object):
+    """Pool of threads writing files atomically."""
+
+    def __init__(self, threads=4, max_pending=64):
+        self._queue = Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._errors = []
+        self.num_files = 0
+        self.num_bytes = 0
+        self._start = time()
+        self._threads = []
+        for _ in range(threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(raise_errors=exc_type is None)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            func, fpath, data = job
+            tmp_fpath = fpath + ".tmp"
+            try:
+                func(tmp_fpath, data)
+                os.rename(tmp_fpath, fpath)
+                size = os.path.getsize(fpath)
+            except Exception as e:
+                if os.path.isfile(tmp_fpath):
+                    os.remove(tmp_fpath)
+                with self._lock:
+                    self._errors.append((fpath, e))
+                continue
+            with self._lock:
+                self.num_files += 1
+                self.num_bytes += size
+
+    def write_png(self, fpath, array):
+        """Queue array to be written as a png file."""
+        self._queue.put((_write_png, fpath, array))
+
+    def write_npz(self, fpath, array):
+        """Queue array to be written as a compressed npz file."""
+        self._queue.put((_write_npz, fpath, array))
+
+    def write_json(self, fpath, data):
+        """Queue data to be written as a json file.
+
+        The data is serialised straight away, so it may be modified once
+        this method returns.
+        """
+        self._queue.put((_write_text, fpath, json.dumps(data)))
+
+    def close(self, raise_errors=True):
+        """Wait for all pending writes and log the throughput.
+
+        :raises: RuntimeError if any of the writes failed
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+        elapsed = max(time() - self._start, 1e-6)
+        megabytes = self.num_bytes / (1024. * 1024.)
+        logging.info("Wrote {} files ({:.1f} MB) in {:.1f} s: "
+                     "{:.1f} files/s, {:.2f} MB/s".format(
+                         self.num_files, megabytes, elapsed,
+                         self.num_files / elapsed, megabytes / elapsed))
+
+        if raise_errors and self._errors:
+            fpath, error = self._errors[0]
+            raise(RuntimeError("Failed to write {} files, e.g. {}: {}".format(
+                len(self._errors), fpath, error)))